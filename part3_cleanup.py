@@ -1035,6 +1035,8 @@ def remove_trash(proj_path, run_paths):
                 or re.match(".*\.[eo][0-9]+$", entry.name)
             ) and entry.is_file():
                 trash_files.append(entry.name)
+            elif entry.name == ".report_cache" and entry.is_dir():
+                trash_dirs.append(entry.name) # make_report.py's build cache
 
         if len(trash_files) > 0 or len(trash_dirs) > 0:
             print()
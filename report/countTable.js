@@ -60,7 +60,8 @@
 
     var divname = 'heatmapInner-${hmNbr}';
 
-    var zValues = ${ abundances };
+    var zManifest = ${ manifest };
+    var zValues = decodeHeatmap("${ abundances }", zManifest, ${ exact });
 
     var xBotValues = [${ taxa }];
     var xTopValues = [${ asvs }];
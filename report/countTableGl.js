@@ -0,0 +1,15 @@
+(function () {
+    var zManifest = ${ manifest };
+    var zValues = decodeHeatmap("${ abundances }", zManifest, ${ exact });
+
+    glHeatmap(document.getElementById("heatmapInner-${hmNbr}"), {
+        manifest: zManifest,
+        zValues: zValues,
+        colormap: "${ colormap }",
+        vmin: ${ vmin },
+        vmax: ${ vmax },
+        xBotValues: [${ taxa }],
+        xTopValues: [${ asvs }],
+        yValues: [${ samples }],
+    });
+})();
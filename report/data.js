@@ -75,9 +75,78 @@ var makeHighlight = function (zValues, xTopValues, divSelector) {
         return false;
     };
 };
+var decodeBase64 = function (payload) {
+    var binary = atob(payload);
+    var view = new DataView(new ArrayBuffer(binary.length));
+    for (var i = 0; i < binary.length; i++) {
+        view.setUint8(i, binary.charCodeAt(i));
+    }
+    return view;
+};
+// Decodes a heatmap's relative abundances, sent as base64-encoded little-endian
+// float32 (see zManifest in countTable.js), into one Float32Array per sample.
+// Quantized payloads hold one uint8 level per cell between manifest.zmin and
+// manifest.zmax, and exact holds the float32 values of the non-zero cells by
+// their row-major index. zValues.exact(i, j) gives the value for hover text;
+// zValues.values is the whole row-major matrix, and zValues.exact.indexes and
+// .values the non-zero cells of quantized payloads.
+var decodeHeatmap = function (payload, manifest, exact) {
+    var view = decodeBase64(payload);
+    var nrow = manifest.shape[0];
+    var ncol = manifest.shape[1];
+    var values = new Float32Array(nrow * ncol);
+    if (manifest.dtype == "uint8") {
+        var step = (manifest.zmax - manifest.zmin) / 255;
+        for (var i = 0; i < values.length; i++) {
+            values[i] = manifest.zmin + view.getUint8(i) * step;
+        }
+    } else {
+        for (var i = 0; i < values.length; i++) {
+            values[i] = view.getFloat32(4 * i, true);
+        }
+    }
+    var rows = new Array(nrow);
+    for (var i = 0; i < nrow; i++) {
+        rows[i] = values.subarray(i * ncol, (i + 1) * ncol);
+    }
+    rows.values = values;
+    if (exact) {
+        var indexView = decodeBase64(exact.indexes);
+        var valueView = decodeBase64(exact.values);
+        var indexes = new Uint32Array(manifest.exact);
+        var exactValues = new Float32Array(manifest.exact);
+        for (var i = 0; i < indexes.length; i++) {
+            indexes[i] = indexView.getUint32(4 * i, true);
+            exactValues[i] = valueView.getFloat32(4 * i, true);
+        }
+        rows.exact = function (i, j) {
+            var k = i * ncol + j;
+            var lo = 0;
+            var hi = indexes.length - 1;
+            while (lo <= hi) {
+                var mid = (lo + hi) >> 1;
+                if (indexes[mid] < k) {
+                    lo = mid + 1;
+                } else if (indexes[mid] > k) {
+                    hi = mid - 1;
+                } else {
+                    return exactValues[mid];
+                }
+            }
+            return 0;
+        };
+        rows.exact.indexes = indexes;
+        rows.exact.values = exactValues;
+    } else {
+        rows.exact = function (i, j) {
+            return rows[i][j];
+        };
+    }
+    return rows;
+};
 var highlightMax = function (zValues) {
     
-    var lookup = zValues.map(row => row.reduce((iMax, x, i, arr) => x > arr[iMax] ? i : iMax, 0) );
+    var lookup = zValues.map((row, s) => row.reduce((iMax, x, i) => zValues.exact(s, i) > zValues.exact(s, iMax) ? i : iMax, 0) );
     return function(sampleI) {
         this.highlight({ sample: sampleI, asvID: lookup[sampleI], scroll: true, type: "index" });
         return false;
@@ -89,7 +158,21 @@ var asvHeatmapMaxHighlight = function (sampleI, divname) {
     return false;
 };
 
-    ${asvtablesjs}
+// Each heatmap's and control plot's data is a script of its own in js/data (see
+// main in make_report.py), injected the first time it's needed
+var dataLoaded = {};
+var loadData = function (name, callback) {
+    if (name in dataLoaded) {
+        return;
+    }
+    dataLoaded[name] = true;
+    var element = document.createElement("script");
+    element.src = ".Report_files/js/data/" + name + ".js";
+    if (callback) {
+        element.onload = callback;
+    }
+    document.body.appendChild(element);
+};
 
     % if plotly:
       $(".heatmap").click(function(e) {
@@ -122,9 +205,24 @@ var asvHeatmapMaxHighlight = function (sampleI, divname) {
     }
     var contaminants = [${ contaminants }];
 
-    $("#all-samples .x2tick > text").filter(function () {
-        return contaminants.indexOf($(this).data('unformatted')) > -1
-    }).attr("style", fillRed);
+    var markContaminants = function () {
+        $("#all-samples .x2tick > text").filter(function () {
+            return contaminants.indexOf($(this).data('unformatted')) > -1
+        }).attr("style", fillRed);
+    };
+
+    % if plotly or webgl:
+    // A heatmap is drawn when the Results page is shown with its table picked
+    var loadHeatmap = function () {
+        if ($("#all-samples").is(":visible")) {
+            var tab = $("#asvHeatmapSelect").val();
+            loadData(tab.replace("heatmapTab-", "heatmap-"), markContaminants);
+        }
+    };
+    $("#asvHeatmapSelect").on("change", loadHeatmap);
+    $("#main-tabs").bind("tabsactivate", loadHeatmap);
+    loadHeatmap();
+    % endif
 
 
 
@@ -257,9 +355,24 @@ function parseTf (a)
         });
         }
         
-        ${ pcrNegCtrlJs }
-        ${pcrPosCtrlJs}
-        ${ extNegCtrlJs }
+        // A control plot is drawn when its section scrolls into view
+        ["pcrNegCtrlPlot", "pcrPosCtrlPlot", "extNegCtrlPlot"].forEach(function (name) {
+            var div = document.getElementById(name);
+            if (div === null) {
+                return;
+            }
+            if (!("IntersectionObserver" in window)) {
+                loadData(name);
+                return;
+            }
+            var observer = new IntersectionObserver(function (entries) {
+                if (entries.some(function (entry) { return entry.isIntersecting; })) {
+                    observer.disconnect();
+                    loadData(name);
+                }
+            });
+            observer.observe(div);
+        });
 
         
 (function () { // Remove the loading screen
@@ -335,4 +448,350 @@ $("#main-tabs").bind("tabsactivate", function (event, ui) {
   }
 });
 document.getElementById('asvHeatmapSelect').addEventListener("change", scrollAdjust);
+
+// Heatmaps built with --tiles are a pyramid of PNG tiles (see tilePyramid in
+// make_report.py). Level 0 has a pixel per sample and ASV, shown at cellSize px
+// like the single-image heatmaps, and each further level pools 2 x 2 pixels of
+// the one below and is shown at half the size. Only the tiles in view are loaded.
+// Returns the function that loads them
+var tiledHeatmap = function (viewer) {
+  var pyramid = JSON.parse(viewer.dataset.pyramid);
+  var tab = $(viewer).closest(".tab-pane");
+  var scroller = $(viewer).closest(".horizScrollContainer")[0];
+  var canvas = viewer.getElementsByClassName("tileCanvas")[0];
+  var span = pyramid.tileSize * pyramid.cellSize; // px per tile, at every level
+  var level = 0;
+  var loaded = {};
+
+  var update = function () {
+    var view = scroller.getBoundingClientRect();
+    var rect = canvas.getBoundingClientRect();
+    if (view.width == 0 || view.height == 0) {
+      return; // not shown
+    }
+    var dims = pyramid.levels[level];
+    var nrow = Math.ceil(dims[0] / pyramid.tileSize);
+    var ncol = Math.ceil(dims[1] / pyramid.tileSize);
+    var top = Math.max(0, Math.floor((view.top - rect.top) / span));
+    var bottom = Math.min(nrow, Math.ceil((view.bottom - rect.top) / span));
+    var left = Math.max(0, Math.floor((view.left - rect.left) / span));
+    var right = Math.min(ncol, Math.ceil((view.right - rect.left) / span));
+    for (var r = top; r < bottom; r++) {
+      for (var c = left; c < right; c++) {
+        var key = r + "_" + c;
+        if (key in loaded) {
+          continue;
+        }
+        var img = document.createElement("img");
+        img.src = pyramid.path + "/" + level + "/" + key + ".png";
+        img.style.top = r * span + "px";
+        img.style.left = c * span + "px";
+        img.style.height = Math.min(pyramid.tileSize, dims[0] - r * pyramid.tileSize) * pyramid.cellSize + "px";
+        img.style.width = Math.min(pyramid.tileSize, dims[1] - c * pyramid.tileSize) * pyramid.cellSize + "px";
+        canvas.appendChild(img);
+        loaded[key] = img;
+      }
+    }
+  };
+
+  // Sizes the heatmap for the level, and scales the axis labels to match it
+  var layout = function () {
+    var scale = Math.pow(2, -level);
+    canvas.style.height = pyramid.rows * pyramid.cellSize * scale + "px";
+    canvas.style.width = pyramid.columns * pyramid.cellSize * scale + "px";
+    tab.find(".axistiles.top, .axistiles.bot").css({ "transform-origin": "0 0", transform: "scaleX(" + scale + ")" });
+    tab.find(".axistiles.left").css({ "transform-origin": "0 0", transform: "scaleY(" + scale + ")" });
+    tab.find(".zoomIn").prop("disabled", level == 0);
+    tab.find(".zoomOut").prop("disabled", level == pyramid.levels.length - 1);
+  };
+
+  // Keeps the middle of the view in the middle
+  var zoom = function (newLevel) {
+    var view = scroller.getBoundingClientRect();
+    var rect = canvas.getBoundingClientRect();
+    var factor = Math.pow(2, level - newLevel);
+    var x = (view.left + view.width / 2 - rect.left) * factor;
+    var y = (view.top + view.height / 2 - rect.top) * factor;
+    level = newLevel;
+    canvas.innerHTML = "";
+    loaded = {};
+    layout();
+    rect = canvas.getBoundingClientRect();
+    scroller.scrollLeft += rect.left + x - (view.left + view.width / 2);
+    scroller.scrollTop += rect.top + y - (view.top + view.height / 2);
+    scrollAdjust();
+    update();
+  };
+
+  tab.find(".zoomIn").on("click", function () { zoom(level - 1); });
+  tab.find(".zoomOut").on("click", function () { zoom(level + 1); });
+  tab.find(".tileZoom").toggle(pyramid.levels.length > 1);
+  scroller.addEventListener("scroll", update);
+  layout();
+  return update;
+};
+var tileUpdates = Array.from(document.getElementsByClassName("tiled"), tiledHeatmap);
+var updateTiles = function () {
+  tileUpdates.forEach(function (update) { update(); });
+};
+window.addEventListener('resize', updateTiles);
+$("#main-tabs").bind("tabsactivate", updateTiles);
+document.getElementById('asvHeatmapSelect').addEventListener("change", updateTiles);
+updateTiles();
+
+% if webgl:
+// Heatmaps built with --webgl are drawn on a canvas the size of the view, which
+// sticks to it while the heatmap scrolls underneath. The matrix is a texture with
+// a byte per cell, its color's index in the colormap, and the fragment shader
+// finds the cell and color of every pixel. Hover text is only made for the cell
+// under the pointer.
+//
+// Textures are at most MAX_TEXTURE_SIZE wide and high, so a sample's row is cut
+// into bands of at most that many columns, each a segment of the texture, and a
+// line of the texture holds perLine segments. Segments are in row-major order:
+// segment row * bands + band starts line floor(segment / perLine), at column
+// (segment % perLine) * bandWidth
+var glVertexShader = [
+  "attribute vec2 position;",
+  "void main() {",
+  "  gl_Position = vec4(position, 0.0, 1.0);",
+  "}",
+].join("\n");
+var glFragmentShader = [
+  "#ifdef GL_FRAGMENT_PRECISION_HIGH",
+  "precision highp float;",
+  "#else",
+  "precision mediump float;",
+  "#endif",
+  "uniform sampler2D matrix;",
+  "uniform sampler2D colormap;",
+  "uniform vec2 offset;", // cells left of and above the canvas
+  "uniform float scale;", // cells per device pixel
+  "uniform float height;", // of the canvas, in device pixels
+  "uniform vec2 shape;", // columns, rows
+  "uniform float bandWidth;", // columns per segment of the texture
+  "uniform float bands;", // segments per sample
+  "uniform float perLine;", // segments per line of the texture
+  "uniform vec2 texSize;",
+  "void main() {",
+  "  vec2 cell = floor(offset + vec2(gl_FragCoord.x, height - gl_FragCoord.y) * scale);",
+  "  if (cell.x >= shape.x || cell.y >= shape.y) {",
+  "    discard;",
+  "  }",
+  "  float band = floor((cell.x + 0.5) / bandWidth);",
+  "  float segment = cell.y * bands + band;",
+  "  float line = floor((segment + 0.5) / perLine);",
+  "  vec2 texel = vec2((segment - line * perLine) * bandWidth + cell.x - band * bandWidth, line);",
+  "  float level = texture2D(matrix, (texel + 0.5) / texSize).r;",
+  "  gl_FragColor = texture2D(colormap, vec2((level * 255.0 + 0.5) / 256.0, 0.5));",
+  "}",
+].join("\n");
+
+var glProgram = function (gl) {
+  var program = gl.createProgram();
+  [[gl.VERTEX_SHADER, glVertexShader], [gl.FRAGMENT_SHADER, glFragmentShader]].forEach(function (stage) {
+    var shader = gl.createShader(stage[0]);
+    gl.shaderSource(shader, stage[1]);
+    gl.compileShader(shader);
+    gl.attachShader(program, shader);
+  });
+  gl.linkProgram(program);
+  if (!gl.getProgramParameter(program, gl.LINK_STATUS)) {
+    throw new Error(gl.getProgramInfoLog(program));
+  }
+  return program;
+};
+
+var glTexture = function (gl, unit, format, width, height, pixels) {
+  gl.activeTexture(gl.TEXTURE0 + unit);
+  gl.bindTexture(gl.TEXTURE_2D, gl.createTexture());
+  gl.pixelStorei(gl.UNPACK_ALIGNMENT, 1);
+  gl.texImage2D(gl.TEXTURE_2D, 0, format, width, height, 0, format, gl.UNSIGNED_BYTE, pixels);
+  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_MIN_FILTER, gl.NEAREST);
+  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_MAG_FILTER, gl.NEAREST);
+  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_S, gl.CLAMP_TO_EDGE);
+  gl.texParameteri(gl.TEXTURE_2D, gl.TEXTURE_WRAP_T, gl.CLAMP_TO_EDGE);
+};
+
+// Sets up the viewer with the data of countTableGl.js. Its highlightMax is what
+// the summary table's links call, as for the Plotly heatmaps
+var glUpdates = [];
+var glHeatmap = function (viewer, heatmap) {
+  var cellSize = 15; // px per sample and per ASV, as for the axis labels
+  var scroller = $(viewer).closest(".horizScrollContainer")[0];
+  var extent = viewer.getElementsByClassName("glExtent")[0];
+  var canvas = extent.getElementsByTagName("canvas")[0];
+  var highlighter = viewer.getElementsByClassName("glHighlight")[0];
+  var hover = viewer.getElementsByClassName("glHover")[0];
+  var nrow = heatmap.manifest.shape[0];
+  var ncol = heatmap.manifest.shape[1];
+  var zValues = heatmap.zValues;
+
+  var gl = canvas.getContext("webgl") || canvas.getContext("experimental-webgl");
+  if (!gl) {
+    viewer.textContent = "This browser can't show the heatmap, as it has no WebGL.";
+    return;
+  }
+  // Bands are as even as they can be, and lines hold as few segments as fit the
+  // texture's height. A table with fewer columns than the texture can be wide is
+  // a single band, and lays out as the matrix in row-major order
+  var maxSize = gl.getParameter(gl.MAX_TEXTURE_SIZE);
+  var bands = Math.ceil(ncol / maxSize);
+  var bandWidth = Math.ceil(ncol / bands);
+  var perLine = Math.max(1, Math.ceil(nrow * bands / maxSize));
+  var texSize = [perLine * bandWidth, Math.ceil(nrow * bands / perLine)];
+  if (texSize[0] > maxSize) {
+    viewer.textContent = "This heatmap is too large for this browser's WebGL, whose textures are at most " +
+      maxSize + " x " + maxSize + ". --max-columns makes it smaller.";
+    return;
+  }
+  // index in the texture of the cell at index k of the matrix in row-major order
+  var texelOf = function (k) {
+    var row = Math.floor(k / ncol);
+    var col = k - row * ncol;
+    var band = Math.floor(col / bandWidth);
+    var segment = row * bands + band;
+    var line = Math.floor(segment / perLine);
+    return line * texSize[0] + (segment - line * perLine) * bandWidth + col - band * bandWidth;
+  };
+
+  // Colormap indexes are picked like matplotlib does for the image heatmaps
+  var range = heatmap.vmax - heatmap.vmin;
+  var levelOf = function (value) {
+    if (range > 0) {
+      return Math.max(0, Math.min(255, Math.floor((value - heatmap.vmin) / range * 256)));
+    }
+    return 0;
+  };
+  var levels = new Uint8Array(texSize[0] * texSize[1]);
+  if (zValues.exact.indexes) {
+    // quantized payloads are colored by the exact values of their non-zero cells
+    levels.fill(levelOf(0));
+    for (var k = 0; k < zValues.exact.indexes.length; k++) {
+      levels[texelOf(zValues.exact.indexes[k])] = levelOf(zValues.exact.values[k]);
+    }
+  } else {
+    for (var k = 0; k < zValues.values.length; k++) {
+      levels[texelOf(k)] = levelOf(zValues.values[k]);
+    }
+  }
+
+  var program = glProgram(gl);
+  gl.useProgram(program);
+  glTexture(gl, 0, gl.LUMINANCE, texSize[0], texSize[1], levels);
+  glTexture(gl, 1, gl.RGBA, 256, 1, new Uint8Array(decodeBase64(heatmap.colormap).buffer));
+  var uniforms = {};
+  ["matrix", "colormap", "offset", "scale", "height", "shape", "bandWidth", "bands", "perLine", "texSize"].forEach(function (name) {
+    uniforms[name] = gl.getUniformLocation(program, name);
+  });
+  gl.uniform1i(uniforms.matrix, 0);
+  gl.uniform1i(uniforms.colormap, 1);
+  gl.uniform2f(uniforms.shape, ncol, nrow);
+  gl.uniform1f(uniforms.bandWidth, bandWidth);
+  gl.uniform1f(uniforms.bands, bands);
+  gl.uniform1f(uniforms.perLine, perLine);
+  gl.uniform2f(uniforms.texSize, texSize[0], texSize[1]);
+  // two triangles covering the canvas
+  gl.bindBuffer(gl.ARRAY_BUFFER, gl.createBuffer());
+  gl.bufferData(gl.ARRAY_BUFFER, new Float32Array([-1, -1, 1, -1, -1, 1, -1, 1, 1, -1, 1, 1]), gl.STATIC_DRAW);
+  var position = gl.getAttribLocation(program, "position");
+  gl.enableVertexAttribArray(position);
+  gl.vertexAttribPointer(position, 2, gl.FLOAT, false, 0, 0);
+
+  // Sizes the canvas to the part of the view the heatmap fills, and draws it
+  var update = function () {
+    if (scroller.clientWidth == 0 || scroller.clientHeight == 0) {
+      return; // not shown
+    }
+    var ratio = window.devicePixelRatio || 1;
+    var width = Math.min(extent.offsetWidth, scroller.clientWidth);
+    var height = Math.min(extent.offsetHeight, scroller.clientHeight);
+    if (canvas.width != Math.round(width * ratio) || canvas.height != Math.round(height * ratio)) {
+      canvas.style.width = width + "px";
+      canvas.style.height = height + "px";
+      canvas.width = Math.round(width * ratio);
+      canvas.height = Math.round(height * ratio);
+      gl.viewport(0, 0, canvas.width, canvas.height);
+    }
+    var rect = extent.getBoundingClientRect();
+    var view = canvas.getBoundingClientRect();
+    gl.uniform2f(uniforms.offset, (view.left - rect.left) / cellSize, (view.top - rect.top) / cellSize);
+    gl.uniform1f(uniforms.scale, width / canvas.width / cellSize);
+    gl.uniform1f(uniforms.height, canvas.height);
+    gl.clear(gl.COLOR_BUFFER_BIT);
+    gl.drawArrays(gl.TRIANGLES, 0, 6);
+  };
+
+  var cellAt = function (e) {
+    var rect = extent.getBoundingClientRect();
+    var i = Math.floor((e.clientY - rect.top) / cellSize);
+    var j = Math.floor((e.clientX - rect.left) / cellSize);
+    return i >= 0 && i < nrow && j >= 0 && j < ncol ? [i, j] : null;
+  };
+
+  var highlight = function (i, j, scroll) {
+    highlighter.style.top = i * cellSize + "px";
+    highlighter.style.left = j * cellSize + "px";
+    highlighter.style.height = cellSize + "px";
+    highlighter.style.width = cellSize + "px";
+    highlighter.style.display = "block";
+    if (scroll) {
+      scroller.scrollLeft = (j + 0.5) * cellSize - scroller.clientWidth / 2;
+      scroller.scrollTop = (i + 0.5) * cellSize - scroller.clientHeight / 2;
+      scroller.scrollIntoView({ block: "nearest" });
+    }
+  };
+
+  canvas.addEventListener("mousemove", function (e) {
+    var cell = cellAt(e);
+    if (cell === null) {
+      hover.style.display = "none";
+      return;
+    }
+    var lines = ["Sample: " + heatmap.yValues[cell[0]]];
+    if (heatmap.xTopValues.length > 0) {
+      lines.push(heatmap.xTopValues[cell[1]]);
+    }
+    if (heatmap.xBotValues.length > 0) {
+      lines.push("Taxon: " + heatmap.xBotValues[cell[1]]);
+    }
+    lines.push("Rel. abundance: " + zValues.exact(cell[0], cell[1]).toFixed(heatmap.manifest.digits));
+    hover.textContent = lines.join("\n");
+    hover.style.left = e.clientX + 12 + "px";
+    hover.style.top = e.clientY + 12 + "px";
+    hover.style.display = "block";
+  });
+  canvas.addEventListener("mouseleave", function () {
+    hover.style.display = "none";
+  });
+  canvas.addEventListener("click", function (e) {
+    var cell = cellAt(e);
+    if (cell !== null) {
+      highlight(cell[0], cell[1], false);
+    }
+  });
+
+  // The sample's most abundant column, found when its link is clicked
+  viewer.highlightMax = function (i) {
+    var best = 0;
+    for (var j = 1; j < ncol; j++) {
+      if (zValues.exact(i, j) > zValues.exact(i, best)) {
+        best = j;
+      }
+    }
+    highlight(i, best, true);
+    return false;
+  };
+
+  scroller.addEventListener("scroll", update);
+  glUpdates.push(update);
+  update();
+};
+var updateGl = function () {
+  glUpdates.forEach(function (update) { update(); });
+};
+window.addEventListener('resize', updateGl);
+$("#main-tabs").bind("tabsactivate", updateGl);
+document.getElementById('asvHeatmapSelect').addEventListener("change", updateGl);
+% endif
 % endif
@@ -6,12 +6,17 @@ import argparse
 import datetime
 import os
 import shutil
-import re
 import sys
 import json
 import urllib.parse
 import math
+import io
 import zipfile
+import multiprocessing
+import concurrent.futures
+import functools
+import hashlib
+import base64
 from pathlib import Path
 import numpy as np
 import pandas as pd
@@ -25,6 +30,7 @@ import matplotlib as mpl  # conda install matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.transforms import TransformedBbox, Affine2D, ScaledTranslation
 import matplotlib.font_manager as fm
+from matplotlib.backends.backend_agg import RendererAgg
 
 
 # ALLOW THIS VARIABLE TO DROP THROUGH INTO CHILD FUNCTIONS
@@ -54,9 +60,10 @@ opts = {
 
 
 class Pathwiz(object):
-    def __init__(self, scriptsDir, projectDir):
+    def __init__(self, scriptsDir, projectDir, cacheDir):
         self.sd = scriptsDir  # These are publicly visible
         self.pd = projectDir
+        self.cd = cacheDir
 
     # Converts a relative path in the project directory to an abs path
     def proj(self, path):
@@ -69,6 +76,11 @@ class Pathwiz(object):
     def res(self, path):
         return os.path.join(self.pd, "REPORT/.Report_files", path)
 
+    # Files kept from one build of the report to the next. They're kept out of
+    # REPORT, which is what gets delivered
+    def cache(self, path):
+        return os.path.join(self.cd, path)
+
     # Gets a path relative to the project directory. As a side-effect, makes
     # paths with whitespace safe.
     def relToProj(self, path):
@@ -125,11 +137,27 @@ def main(pw, args):
         print(reportDir + " already exists")
 
     opts["lookup"] = TemplateLookup(directories=[scriptDir], strict_undefined=True)
+    opts["sections"] = set()  # Names of the sections loadSection was asked for
+    opts["tables"] = set()  # Keys of the count tables cachedAsvTable read
     mytemplate = opts["lookup"].get_template("MSL_REPORT.html")
 
-    map_table = getMapHTML(pw) if args.map is not None else None
+    map_table = None
+    if args.map is not None:
+        # the control plots need opts["map"] even when the map's section is cached
+        getMappingFile(pw)
+        map_table = cachedSection(
+            "mapping",
+            [os.path.abspath(args.map), pw.script("mappingToHtml.R")],
+            [config["R"]],
+            lambda: (getMapHTML(pw), []),
+        )
     date = datetime.date.today().isoformat()
-    dada2stats = getDada2Stats(pw)
+    dada2stats = cachedSection(
+        "dada2",
+        sorted([pw.proj(file) for file in glob.glob("*DADA2_stats.txt")]),
+        [],
+        lambda: (getDada2Stats(pw), [os.path.join(reportDir, "DADA2_stats.txt")]),
+    )
     getAsvTables(pw)
 
     # start off the table of contents
@@ -145,6 +173,7 @@ def main(pw, args):
     # Get content on controls.
     # returns list. Order matters bc the toc is ordered!
     ctrlContent = {}
+    dataFiles = {}
     ctrlPars = initControlsParams()
     for pars in ctrlPars:
         # If this project contained controls, getCtrlPlots returns html and js
@@ -154,6 +183,7 @@ def main(pw, args):
 
         ctrlContent[pars.title] = content
         if len(content["js"]) > 0:
+            dataFiles[pars.prefix + "CtrlPlot"] = content["js"]
             toc.append(
                 '<li><a href="#'
                 + pars.urlsafe
@@ -167,6 +197,18 @@ def main(pw, args):
 
     # must get contaminants from getCtrlPlots() before creating axis labels here
     asvTables = createAsvHeatmaps(pw)
+    dataFiles.update(asvTables["js"])
+
+    qc = cachedSection(
+        "fastqc",
+        [
+            pw.proj(os.path.join(run, "libraries", strand, "seqs_fastqc.zip"))
+            for run in args.runs
+            for strand in ("fwd", "rev")
+        ],
+        [args.runs],
+        lambda: (str(fastqc(pw)), walkFiles(os.path.join(reportDir, "FastQC"))),
+    )
 
     f = open(os.path.join(reportDir, "Report.html"), "w+")
     f.write(
@@ -174,7 +216,7 @@ def main(pw, args):
             date=date,
             mapping=map_table,
             dada2stats=dada2stats,
-            qc=fastqc(pw),
+            qc=qc,
             asvtableshtml=asvTables["html"],
             pcrNegCtrlHtml=ctrlContent["PCR Neg. Controls"]["html"],
             pcrPosCtrlHtml=ctrlContent["PCR Pos. Controls"]["html"],
@@ -188,19 +230,26 @@ def main(pw, args):
         [os.path.join(scriptDir, subdir) for subdir in ("js", "css")], reportFilesDir
     )
 
+    # Each heatmap's and control plot's data is a file of its own in js/data, which
+    # data.js only loads once the heatmap's tab is picked or the plot is scrolled to
+    os.makedirs(pw.res("js/data"), exist_ok=True)
+    for name, js in dataFiles.items():
+        with open(pw.res("js/data/" + name + ".js"), "w") as f:
+            f.write(js)
+
     mytemplate = opts["lookup"].get_template("data.js")
     with open(pw.res("js/data.js"), "w") as f:
         f.write(
             mytemplate.render(
-                asvtablesjs=asvTables["js"],
-                pcrNegCtrlJs=ctrlContent["PCR Neg. Controls"]["js"],
-                pcrPosCtrlJs=ctrlContent["PCR Pos. Controls"]["js"],
-                extNegCtrlJs=ctrlContent["Extraction Neg. Controls"]["js"],
                 contaminants=", ".join([enquote(c) for c in opts["contaminants"]]),
                 plotly=args.plotly,
+                webgl=args.webgl,
             )
         )
 
+    pruneCache("sections", opts["sections"])
+    pruneCache("axes", stripsInReport())
+    pruneCache("tables", opts["tables"])
     print("Report created at " + os.path.join(reportDir, "Report.html"))
 
 
@@ -224,6 +273,115 @@ def overwriteDir(directory):
     os.makedirs(directory)
 
 
+# Sections of the report (the sample map, DADA2 stats, FastQC and the heatmap of
+# each count table) are kept in the sections directory of the cache with a
+# fingerprint of what went into them: their input files, the templates, this
+# script and the options they depend on. A rebuild reuses a section whose
+# fingerprint hasn't changed, putting back the files it had written to REPORT, and
+# builds the others, replacing their stale entries
+def sectionFingerprint(name, inputs, params):
+    inputs = [os.path.abspath(__file__)] + inputs
+    key = [name, [[path, inputHash(path)] for path in inputs], params]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+# A file's contents, or None if it doesn't exist
+def inputHash(filepath):
+    return fileHash(filepath) if os.path.isfile(filepath) else None
+
+
+# Returns what the section returned when it was last built with this fingerprint,
+# or None. Choices made in --interactive mode aren't part of fingerprints, so
+# nothing is reused then
+def loadSection(name, fingerprint):
+    opts["sections"].add(name)
+    if args.rebuild or args.interactive:
+        return None
+    entryDir = pw.cache(os.path.join("sections", name))
+    try:
+        with open(os.path.join(entryDir, "section.json"), "r") as f:
+            entry = json.load(f)
+        if entry["fingerprint"] != fingerprint:
+            return None
+        for path in entry["files"]:
+            dest = os.path.join(pw.pd, "REPORT", path)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            replaceFile(os.path.join(entryDir, "files", path), dest)
+    except (OSError, ValueError, KeyError):
+        return None
+    if args.verbose:
+        print("Reusing the " + name + " section of the last build")
+    return entry["result"]
+
+
+# Keeps a section's result and copies of the files it wrote to REPORT
+def storeSection(name, fingerprint, result, files):
+    if args.interactive:
+        return
+    entryDir = pw.cache(os.path.join("sections", name))
+    shutil.rmtree(entryDir, ignore_errors=True)
+    os.makedirs(entryDir)
+    files = [pw.relToRep(path) for path in files]
+    for path in files:
+        dest = os.path.join(entryDir, "files", path)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(os.path.join(pw.pd, "REPORT", path), dest)
+    entry = {"fingerprint": fingerprint, "result": result, "files": files}
+    writeCacheEntry(os.path.join(entryDir, "section.json"), json.dumps(entry))
+
+
+# build() returns the section's result and the files it wrote to REPORT
+def cachedSection(name, inputs, params, build):
+    fingerprint = sectionFingerprint(name, inputs, params)
+    result = loadSection(name, fingerprint)
+    if result is None:
+        result, files = build()
+        storeSection(name, fingerprint, result, files)
+    return result
+
+
+# Removes the entries of a directory of the cache that this build didn't use (e.g.
+# the heatmap section and parsed copy of a count table that's gone, or label
+# strips of samples that were renamed), so the cache only holds what the next
+# build can reuse. Entries are named by their key, up to the first "."
+def pruneCache(directory, used):
+    if args.interactive:
+        return
+    try:
+        entries = list(os.scandir(pw.cache(directory)))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name.split(".")[0] in used:
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+# Keys of the label strips in the report, whether drawn by cachedStrips or put
+# back with a cached section
+def stripsInReport():
+    prefix = "axis-"
+    return set(
+        name[len(prefix) :].split(".")[0]
+        for name in os.listdir(pw.res("img"))
+        if name.startswith(prefix)
+    )
+
+
+def walkFiles(directory):
+    return [
+        os.path.join(root, file)
+        for root, dirs, files in os.walk(directory)
+        for file in sorted(files)
+    ]
+
+
 def softMkDir(directory):
     try:
         shutil.rmtree(directory)
@@ -471,7 +629,7 @@ def fastqc(pw):
     rundirs = [pw.proj(run) for run in args.runs]
     # REPORT is a keyword directory that is never considered a run directory
     # Might want to change this so the user can select specific directories as runs.
-    runs = 0
+    runs = []
 
     for rundir in rundirs:  # Get FastQC report from each run folder
         p = Path(rundir)
@@ -532,44 +690,7 @@ def fastqc(pw):
         # Now fwdFastQc and revFastQc are lists containing zero or one filename to a zip folder
 
         if (len(fwdFastQc) == 1) and (len(revFastQc) == 1):
-            runs += 1
-            fwdFastQc = str(fwdFastQc[0])
-            revFastQc = str(revFastQc[0])
-
-            for zipdir in (fwdFastQc, revFastQc):
-                with zipfile.ZipFile(zipdir, "r") as zip_ref:
-                    zip_ref.extractall(os.path.dirname(zipdir[0 : len(zipdir) - 4]))
-            fwdFastQc = fwdFastQc[0 : len(fwdFastQc) - 4]
-            revFastQc = revFastQc[0 : len(revFastQc) - 4]
-
-            def processDir(dir, desc):
-                ans = ""
-                # COPY all images to the appropriate report folder and get their
-                # filepaths (dict of test:filepath pairs)
-                imgs = getFastqcLocal(directory=dir)
-                # Get the status flags, which have been computed according to our custom rules
-                # returns dict of test:status pairs
-                statuses = parseFastqcSummary(dir)
-
-                for test in opts["tests"]:
-                    # Relative to report.html in project directory
-                    dirs = imgs[test].split(os.sep)
-                    pathRel = os.sep.join(dirs[len(dirs) - 4 : len(dirs)])
-                    ans += tagFastqc(pathRel) + "\n"
-                    ans += captionFastqc(test, statuses[test])
-                sectionHead = htmltag.h3(desc)
-                paragraph = htmltag.p(htmltag.HTML(ans))
-                div = htmltag.div(htmltag.HTML(paragraph))
-                return htmltag.div(htmltag.HTML(sectionHead + div), _class="accordion")
-
-            fwd = processDir(fwdFastQc, "Forward reads")
-            rev = processDir(revFastQc, "Reverse reads")
-
-            sectionHead = htmltag.h2(os.path.basename(rundir))
-            ans += htmltag.div(
-                htmltag.HTML(sectionHead + htmltag.div(htmltag.HTML(fwd + rev))),
-                _class="accordion accordionRun",
-            )
+            runs.append((rundir, str(fwdFastQc[0]), str(revFastQc[0])))
         else:
             if len(fwdFastQc) == 0:
                 checkedDirs = os.path.join(str(rundir), "libraries", "fwd", "seqs_fastqc")
@@ -590,6 +711,11 @@ def fastqc(pw):
                     + "\n"
                 )
 
+    # The runs' zips are read in threads, as most of the time goes to waiting on
+    # the file system
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        ans = "".join(executor.map(lambda run: fastqcRun(*run), runs))
+
     if len(ans) > 0:
         script = htmltag.HTML(
             """
@@ -598,7 +724,7 @@ def fastqc(pw):
                         $( ".accordionRun" ).accordion( "option", "active", 0 );
                 </script>"""
         )
-        if runs == 1:
+        if len(runs) == 1:
             script = script.append(
                 """$( ".accordionRun" ).accordion( "option", "collapsible", false );
                                 """
@@ -606,19 +732,60 @@ def fastqc(pw):
     return ans + script
 
 
+# The FastQC section of one run, from the zips of its forward and reverse reads
+def fastqcRun(rundir, fwdFastQc, revFastQc):
+    def processZip(zipPath, desc):
+        ans = ""
+        with zipfile.ZipFile(zipPath, "r") as archive:
+            # WRITE the images to the appropriate report folder and get their
+            # filepaths (dict of test:filepath pairs)
+            imgs = getFastqcLocal(archive)
+            # Get the status flags, which have been computed according to our custom rules
+            # returns dict of test:status pairs
+            statuses = parseFastqcSummary(archive)
+
+        for test in opts["tests"]:
+            # Relative to report.html in project directory
+            dirs = imgs[test].split(os.sep)
+            pathRel = os.sep.join(dirs[len(dirs) - 4 : len(dirs)])
+            ans += tagFastqc(pathRel) + "\n"
+            ans += captionFastqc(test, statuses[test])
+        sectionHead = htmltag.h3(desc)
+        paragraph = htmltag.p(htmltag.HTML(ans))
+        div = htmltag.div(htmltag.HTML(paragraph))
+        return htmltag.div(htmltag.HTML(sectionHead + div), _class="accordion")
+
+    fwd = processZip(fwdFastQc, "Forward reads")
+    rev = processZip(revFastQc, "Reverse reads")
+
+    sectionHead = htmltag.h2(os.path.basename(rundir))
+    return htmltag.div(
+        htmltag.HTML(sectionHead + htmltag.div(htmltag.HTML(fwd + rev))),
+        _class="accordion accordionRun",
+    )
+
+
+# The members of a FastQC zip are under a folder named like the zip
+def fastqcMember(archive, path):
+    folder = os.path.splitext(os.path.basename(archive.filename))[0]
+    return archive.read(folder + "/" + path)
+
+
 """
-COPY all images to the appropriate report folder and get their filepaths
+WRITE the images of a FastQC zip to the appropriate report folder and get their
+filepaths
 """
 
 
-def getFastqcLocal(directory):
+def getFastqcLocal(archive):
     ans = {}
-    run = os.path.basename(os.path.dirname(os.path.dirname(os.path.dirname(directory))))
+    libraryDir = os.path.dirname(archive.filename)
+    run = os.path.basename(os.path.dirname(os.path.dirname(libraryDir)))
     imgDir = os.path.join(pw.proj("REPORT"), "FastQC")
 
     # Get the images in this fastqc analysis
     imgs = [
-        os.path.join(directory, "Images", filename)
+        "Images/" + filename
         for filename in (
             "per_base_quality.png",
             "per_tile_quality.png",
@@ -628,14 +795,15 @@ def getFastqcLocal(directory):
 
     # R1_fastqc, R2_fastqc, or R4_fastqc, depending on the project directory layout
     dirSpecificDir = os.path.join(
-        imgDir, run, os.path.basename(os.path.dirname(directory))[0:2] + "_fastqc"
+        imgDir, run, os.path.basename(libraryDir)[0:2] + "_fastqc"
     )
     overwriteDir(dirSpecificDir)
     if len(imgs) == len(opts["tests"]):
         for i in range(len(imgs)):
-            file = imgs[i]
-            imgDest = os.path.join(dirSpecificDir, os.path.basename(file))
-            shutil.copy2(file, imgDest)
+            member = imgs[i]
+            imgDest = os.path.join(dirSpecificDir, os.path.basename(member))
+            with open(imgDest, "wb") as f:
+                f.write(fastqcMember(archive, member))
             ans[opts["tests"][i]] = imgDest
     return ans
 
@@ -649,16 +817,15 @@ From the fastQC summary.txt, read the test results from four tests:
 """
 
 
-def parseFastqcSummary(directory):
+def parseFastqcSummary(archive):
     ans = {}
 
-    f = open(os.path.join(directory, "summary.txt"), "r")
-    for line in f.readlines():
+    summary = fastqcMember(archive, "summary.txt").decode()
+    for line in summary.splitlines(keepends=True):
         fields = line.split("\t")
         for test in opts["tests"]:
             if test in fields[1]:
                 ans[test] = fields[0]
-    f.close
     return ans
 
 
@@ -778,19 +945,107 @@ def getAsvTables(pw):
         )
 
     for file in include:
-        opts["asvDfs"][file] = readAsvTable(pw.proj(file))
+        opts["asvDfs"][file] = cachedAsvTable(pw.proj(file))
 
     return True
 
 
+# Bump when readAsvTable starts returning something different for the same file
+ASV_TABLE_CACHE_FORMAT = 2
+
+
+# Parsed count tables are kept in the tables directory of the cache as Parquet, so a rebuild of
+# the report only parses the tables that changed. A table's entry is found by its
+# path and reused while the file's size and mtime, or else its contents, are those
+# it was parsed from. Without pyarrow, tables are parsed every time
+def cachedAsvTable(filepath):
+    cacheDir = pw.cache("tables")
+    os.makedirs(cacheDir, exist_ok=True)
+    stat = os.stat(filepath)
+    meta = {
+        "format": ASV_TABLE_CACHE_FORMAT,
+        "path": os.path.abspath(filepath),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+    }
+    key = hashlib.sha256(meta["path"].encode()).hexdigest()
+    opts["tables"].add(key)
+    metaPath = os.path.join(cacheDir, key + ".json")
+    dataPath = os.path.join(cacheDir, key + ".parquet")
+
+    try:
+        with open(metaPath, "r") as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
+    fresh = all(cached.get(field) == meta[field] for field in meta)
+    sameSize = cached.get("size") == meta["size"]
+    if not fresh and sameSize and cached.get("format") == meta["format"]:
+        # e.g. a copied or touched file
+        meta["sha256"] = fileHash(filepath)
+        fresh = cached.get("sha256") == meta["sha256"]
+
+    try:
+        if fresh:
+            if args.verbose:
+                print("Reading " + filepath + " from the cache ...")
+            df = pd.read_parquet(dataPath)
+            df.index.name = cached["index"]
+            df.columns = pd.MultiIndex.from_arrays(
+                cached["columns"], names=cached["names"]
+            )
+            if cached["filled"]:
+                warnMissingValues(filepath)
+            if cached["mtime"] != meta["mtime"]:
+                cached["mtime"] = meta["mtime"]
+                writeCacheEntry(metaPath, json.dumps(cached))
+            return df
+    except ImportError:
+        return readAsvTable(filepath)[0]
+    except (OSError, ValueError, KeyError):
+        pass  # a damaged entry is replaced below
+
+    df, meta["filled"] = readAsvTable(filepath)
+    if "sha256" not in meta:
+        meta["sha256"] = fileHash(filepath)
+    # Parquet wants unique string column names, so the header rows are kept in
+    # the JSON next to it
+    meta["index"] = df.index.name
+    meta["names"] = list(df.columns.names)
+    meta["columns"] = [
+        df.columns.get_level_values(i).tolist() for i in range(df.columns.nlevels)
+    ]
+    flat = pd.DataFrame(
+        df.to_numpy(),
+        index=df.index.rename(None),
+        columns=[str(i) for i in range(len(df.columns))],
+    )
+    try:
+        tmp = dataPath + "." + str(os.getpid()) + ".tmp"
+        flat.to_parquet(tmp)
+        os.replace(tmp, dataPath)
+        writeCacheEntry(metaPath, json.dumps(meta))
+    except ImportError:
+        pass
+    return df
+
+
+def writeCacheEntry(filepath, content):
+    tmp = filepath + "." + str(os.getpid()) + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, filepath)
+
+
+# Returns the table and whether missing values had to be replaced with 0
 def readAsvTable(filepath):
     if args.verbose:
         print("Reading " + filepath + " ...")
 
     headers = []
     with open(filepath, "r") as f:
-        for i in [0, 1]:
-            line = f.readline()
+        lines = [f.readline(), f.readline()]
+        for i, line in enumerate(lines):
             try:
                 abundances = line.strip().rstrip(",").split(",")[1:]
                 # Next line throws ValueError if header line
@@ -798,23 +1053,70 @@ def readAsvTable(filepath):
             except ValueError:
                 headers.append(i)
 
-    # must do this to get columns with duplicate names
-    df = pd.read_csv(filepath, header=None, dtype="str")  # note header=None
-    df = df.set_index(df.keys()[0])  # https://github.com/pandas-dev/pandas/issues/9435
-    if df.isnull().sum().sum() > 0:
-        print(
-            "Warning: Missing values in "
-            + filepath
-            + " have been replaced with 0. Inspect the original CSV with extreme caution!"
+        # The header rows are kept as strings and become the column MultiIndex
+        # (read separately so that duplicate column names survive)
+        head = pd.read_csv(
+            io.StringIO("".join([lines[i] for i in headers])),
+            header=None,
+            index_col=0,
+            dtype="str",
         )
+        # The body is parsed straight into int32 counts, without a string per count,
+        # or int64 ones if a count may be too large for int32. Integer columns
+        # can't hold missing values, so tables with gaps are parsed again with the
+        # column types left to pandas
+        countType = np.int64 if hasLongCounts(filepath) else np.int32
+        dtype = {i: countType for i in range(1, len(head.columns) + 1)}
+        dtype[0] = str
+        try:
+            f.seek(0)
+            df = pd.read_csv(f, header=None, skiprows=headers, index_col=0, dtype=dtype)
+        except ValueError:
+            f.seek(0)
+            df = pd.read_csv(
+                f, header=None, skiprows=headers, index_col=0, dtype={0: str}
+            )
+
+    filled = head.isnull().sum().sum() + df.isnull().sum().sum() > 0
+    if filled:
+        warnMissingValues(filepath)
         # Prevent errors in next step (extra columns should be visible to user in final report)
+        head.fillna(0, inplace=True)
         df.fillna(0, inplace=True)
 
-    df.columns = pd.MultiIndex.from_frame(df.iloc[headers].T.astype(str))
-    # drop header rows
-    df = df.iloc[[x not in headers for x in range(len(df.index))]]
-    df = df.astype(int)  # allow dataframe to fix itself
-    return df
+    df.columns = pd.MultiIndex.from_frame(head.T.astype(str))
+    limits = np.iinfo(np.int32)
+    if df.size > 0 and (df.min().min() < limits.min or df.max().max() > limits.max):
+        df = df.astype(np.int64)
+    else:
+        df = df.astype(np.int32)
+    return df, bool(filled)
+
+
+# Maps digits to "0" and drops the other characters a count may have around it
+COUNT_DIGITS = (bytes.maketrans(b"0123456789", b"0" * 10), b' \t\r"+-')
+
+
+# pandas parses a count of 2^31 or more into int32 by wrapping it around, without a
+# word. Such counts have at least 10 digits, so this looks for a field that long
+# after a comma (i.e. not a row's name)
+def hasLongCounts(filepath):
+    tail = b""
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 24), b""):
+            block = tail + block.translate(*COUNT_DIGITS)
+            if b",0000000000" in block:
+                return True
+            tail = block[-16:]
+    return False
+
+
+def warnMissingValues(filepath):
+    print(
+        "Warning: Missing values in "
+        + filepath
+        + " have been replaced with 0. Inspect the original CSV with extreme caution!"
+    )
 
 
 def df_to_js(df, float_format=None):
@@ -830,161 +1132,209 @@ def df_to_js(df, float_format=None):
     return "".join(items)
 
 
-def createAsvHeatmaps(pw):
+# Renders the heatmap images and the countTable.html/countTable.js fragments of one
+# count table. Returns them as {"html": ..., "js": ...}
+def createAsvHeatmap(file, df, heatmapNbr):
     os.chdir(pw.pd)
+    fields = os.path.splitext(file)[0].split(sep=".")
+
+    active = "active" if heatmapNbr == 1 else ""
+    title = ""
+    tbody = ""
+    abundances = ""
+    manifest = ""
+    exact = "null"
+    taxa = []
+    asvIDs = []
+    nCol = 0
+    xAxes = ""
+    data = ""
+    zmin = 0
+    zmax = 0
+    topMargin = 40
 
-    html = ""
-    js = ""
-    heatmapNbr = 1
-    for file in opts["asvDfs"].keys():
-        fields = os.path.splitext(file)[0].split(sep=".")
-
-        active = "active" if heatmapNbr == 1 else ""
-        title = ""
-        tbody = ""
-        data_str = ""
-        taxa = []
-        asvIDs = []
-        nCol = 0
-        xAxes = ""
-        data = ""
-        zmin = 0
-        zmax = 0
-        topMargin = 40
-
-        if args.verbose:
-            print("Preparing " + file + " for the report.")
-
-        shutil.copyfile(
-            os.path.join(file), os.path.join(pw.pd, "REPORT", os.path.basename(file))
-        )
+    if args.verbose:
+        print("Preparing " + file + " for the report.")
 
-        taxnmy = fields[len(fields) - 2]
-        if taxnmy == "PECAN-SILVA":
-            taxnmy += "*"
-        taxnmy = taxnmy.capitalize()
+    shutil.copyfile(
+        os.path.join(file), os.path.join(pw.pd, "REPORT", os.path.basename(file))
+    )
 
-        form = fields[len(fields) - 1]
-        if form in ("taxa", "taxa+asvs", "asvs+taxa"):
-            title = "ASV counts labeled with " + taxnmy + " taxonomic assignments"
-        elif form == "taxa-merged":
-            title = "Counts by " + taxnmy + " taxonomic assignment"
-        else:
-            print("Error: can't determine count table file format from filename.")
+    taxnmy = fields[len(fields) - 2]
+    if taxnmy == "PECAN-SILVA":
+        taxnmy += "*"
+    taxnmy = taxnmy.capitalize()
 
-        # Get rid of rows with 0 sum (no surviving reads)
-        rowsums = opts["asvDfs"][file].sum(axis=1)
-        goodRows = [i for i, rowsum in enumerate(rowsums) if rowsum != 0]
-        rowsums = [rowsums[i] for i in goodRows]
-        dfZeroSafe = opts["asvDfs"][file].iloc[goodRows]
+    form = fields[len(fields) - 1]
+    if form in ("taxa", "taxa+asvs", "asvs+taxa"):
+        title = "ASV counts labeled with " + taxnmy + " taxonomic assignments"
+    elif form == "taxa-merged":
+        title = "Counts by " + taxnmy + " taxonomic assignment"
+    else:
+        print("Error: can't determine count table file format from filename.")
 
-        # Get the one or two headers in the dataframe and determine whether
-        # they are ASV IDs or taxa
-        for i in range(2):
-            try:
-                colnames = list(dfZeroSafe.columns.get_level_values(i))
-                if all([str(name)[0:3] == "ASV" for name in colnames]):
-                    asvIDs = colnames
-                else:
-                    taxa = colnames
-            except IndexError:
-                break
-        if args.plotly:
-            sampleIDs = [enquote(id) for id in list(dfZeroSafe.index)]
-        else:
-            sampleIDs = list(dfZeroSafe.index)
-
-        # Create an HTML table body for displaying a table of samples, total reads, and top hits
-        tdata = []
-        for index, row in opts["asvDfs"][file].iterrows():
-            if sum(row) > 0:
-                tophiti = row.values.argmax()  # index of top hit
-
-                if isinstance(tophiti, slice):
-                    tophiti = str(tophiti)
-                    tophiti = int(
-                        re.search("(?<=slice\()[0-9]+", str(tophiti)).group(0)
-                    )
+    # Total reads and the column of the top hit of every sample
+    counts = df.to_numpy()
+    totals = counts.sum(axis=1)
 
-                topASV = asvIDs[tophiti] if len(asvIDs) > 0 else ""
-                topTaxon = taxa[tophiti] if len(taxa) > 0 else ""
-            else:  # sample had no surviving reads
-                topASV = "--"
-                topTaxon = ""
-            tdata.append([index, sum(row), [topASV, topTaxon]])
-
-        def maketd(data):
-            return """<td style="text-align:left;">""" + str(data) + "</td>\n"
-
-        omittedRowCounter = 0
-
-        def makerow(row, i):
-            nonlocal omittedRowCounter
-            tr = ["<tr>"]
-            tr.append(maketd(row[0]))
-            tr.append(maketd(row[1]))
-            asv = row[2][0]
-            taxon = row[2][1]
-            taxonStr = taxon if (len(taxon) > 0) else ""
-            if form != "taxa-merged":
-                taxonStr = "(" + taxonStr + ")"
-            tablecell = asv + " " + taxonStr
-            if row[2][0] == "--":
-                omittedRowCounter += 1
+    # Get rid of rows with 0 sum (no surviving reads)
+    goodRows = np.flatnonzero(totals != 0)
+    rowsums = totals[goodRows]
+    dfZeroSafe = df.iloc[goodRows]
+
+    # Get the one or two headers in the dataframe and determine whether
+    # they are ASV IDs or taxa
+    for i in range(2):
+        try:
+            colnames = list(dfZeroSafe.columns.get_level_values(i))
+            if all([str(name)[0:3] == "ASV" for name in colnames]):
+                asvIDs = colnames
             else:
-                if args.plotly:
-                    tablecell = (
-                        '<a onclick="asvHeatmapMaxHighlight('
-                        + str(i - omittedRowCounter)
-                        + ", 'heatmapInner-"
-                        + str(heatmapNbr)
-                        + '\')" href="#!">'
-                        + tablecell
-                        + "</a>"
-                    )
-            tr.append(maketd(tablecell))
-            tr.append("</tr>")
-            return "\n".join(tr)
-
-        tbody = "\n".join([makerow(row, i) for i, row in enumerate(tdata)])
-
-        # Add quotes to each xlabel (for javascript syntax)
-        if args.plotly:
-            taxa = [enquote(taxon) for taxon in taxa]
-            asvIDs = [enquote(asvID) for asvID in asvIDs]
-
-        relAbund = opts["asvDfs"][file].iloc[goodRows].div(rowsums, axis="index")
-        zmin = relAbund.min().min()
-        zmax = relAbund.max().max()
-        zmax = zmax if zmax < 0.3 else np.ceil(zmax * 10) / 10
-
-        # Reorder by sum(relative abundance) across samples
-        colsums = relAbund.sum(axis=0)
-        relAbundOrder = list(colsums.argsort().iloc[::-1])
-        relAbund = relAbund.iloc[:, relAbundOrder]
+                taxa = colnames
+        except IndexError:
+            break
+    if args.plotly:
+        sampleIDs = [enquote(id) for id in list(dfZeroSafe.index)]
+    else:
+        sampleIDs = list(dfZeroSafe.index)
+
+    # Order columns by sum(relative abundance) across samples
+    relAbund = df.iloc[goodRows].div(rowsums, axis="index")
+    colsums = relAbund.sum(axis=0)
+    relAbundOrder = list(colsums.argsort().iloc[::-1])
+
+    # With --max-columns, the columns after the most abundant ones are summed into
+    # a single "Other" column, for the heatmap and the summary table alike
+    if args.max_columns is not None and len(relAbundOrder) > args.max_columns:
+        kept = relAbundOrder[: args.max_columns]
+        rest = relAbundOrder[args.max_columns :]
+        counts = np.column_stack([counts[:, kept], counts[:, rest].sum(axis=1)])
+        relAbund = pd.DataFrame(
+            counts[goodRows] / rowsums[:, np.newaxis], index=relAbund.index
+        )
         if len(taxa) > 0:
-            taxa = [taxa[i] for i in relAbundOrder]
-
+            taxa = [taxa[i] for i in kept] + ["Other"]
         if len(asvIDs) > 0:
-            asvIDs = [asvIDs[i] for i in relAbundOrder]
-            topMargin = 100
-        nCol = len(taxa) if len(taxa) > 0 else len(asvIDs)
-
-        if args.plotly:
-            data_str = df_to_js(
-                relAbund,
-                float_format="{:."
-                + str(int(np.amax(np.ceil(np.log10(rowsums)))))
-                + "f}",
-            )
-            data_str = "[[" + data_str[0 : (len(data_str) - 4)] + "]]\n"
-            relAbundOrder = "[" + ", ".join([str(x) for x in relAbundOrder]) + "]\n"
+            asvIDs = [asvIDs[i] for i in kept] + ["Other"]
+        relAbundOrder = list(range(len(kept) + 1))
+    tophits = counts.argmax(axis=1) if counts.size > 0 else np.zeros(len(counts), int)
+
+    # Create an HTML table body for displaying a table of samples, total reads, and top hits
+    tdata = []
+    for index, total, tophiti in zip(df.index, totals, tophits):
+        if total > 0:
+            topASV = asvIDs[tophiti] if len(asvIDs) > 0 else ""
+            topTaxon = taxa[tophiti] if len(taxa) > 0 else ""
+        else:  # sample had no surviving reads
+            topASV = "--"
+            topTaxon = ""
+        tdata.append([index, total, [topASV, topTaxon]])
+
+    def maketd(data):
+        return """<td style="text-align:left;">""" + str(data) + "</td>\n"
+
+    omittedRowCounter = 0
+
+    def makerow(row, i):
+        nonlocal omittedRowCounter
+        tr = ["<tr>"]
+        tr.append(maketd(row[0]))
+        tr.append(maketd(row[1]))
+        asv = row[2][0]
+        taxon = row[2][1]
+        taxonStr = taxon if (len(taxon) > 0) else ""
+        if form != "taxa-merged":
+            taxonStr = "(" + taxonStr + ")"
+        tablecell = asv + " " + taxonStr
+        if row[2][0] == "--":
+            omittedRowCounter += 1
+        else:
+            if args.plotly or args.webgl:
+                tablecell = (
+                    '<a onclick="asvHeatmapMaxHighlight('
+                    + str(i - omittedRowCounter)
+                    + ", 'heatmapInner-"
+                    + str(heatmapNbr)
+                    + '\')" href="#!">'
+                    + tablecell
+                    + "</a>"
+                )
+        tr.append(maketd(tablecell))
+        tr.append("</tr>")
+        return "\n".join(tr)
 
-        htmlTemplate = opts["lookup"].get_template("countTable.html")
-        jsTemplate = opts["lookup"].get_template("countTable.js")
-        data = "["
-        if len(asvIDs) > 0:
-            xAxes += """xaxis2: {
+    tbody = "\n".join([makerow(row, i) for i, row in enumerate(tdata)])
+
+    # Add quotes to each xlabel (for javascript syntax)
+    if args.plotly:
+        taxa = [enquote(taxon) for taxon in taxa]
+        asvIDs = [enquote(asvID) for asvID in asvIDs]
+
+    zmin = relAbund.min().min()
+    zmax = relAbund.max().max()
+    zmax = zmax if zmax < 0.3 else np.ceil(zmax * 10) / 10
+
+    relAbund = relAbund.iloc[:, relAbundOrder]
+    if len(taxa) > 0:
+        taxa = [taxa[i] for i in relAbundOrder]
+
+    if len(asvIDs) > 0:
+        asvIDs = [asvIDs[i] for i in relAbundOrder]
+        topMargin = 100
+    nCol = len(taxa) if len(taxa) > 0 else len(asvIDs)
+
+    if args.plotly or args.webgl:
+        # The matrix goes to the browser as base64-encoded little-endian float32,
+        # which countTable.js (or countTableGl.js) decodes into Float32Arrays as the
+        # manifest describes
+        manifest = {
+            "shape": list(relAbund.shape),
+            "dtype": "float32",
+            "byteorder": "little",
+            "order": "row-major",
+            "rows": "samples",
+            "columns": "by total relative abundance, descending",
+            # decimals shown in the hover text
+            "digits": int(np.amax(np.ceil(np.log10(rowsums)))),
+        }
+        if args.quantize:
+            # The colors only need 256 levels between zmin and zmax. The hover
+            # text reads the exact float32 values of the non-zero cells, which are
+            # looked up by their row-major index
+            values = relAbund.to_numpy(dtype=np.float64)
+            scale = (zmax - zmin) or 1
+            levels = np.rint((values - zmin) / scale * 255).clip(0, 255)
+            abundances = base64.b64encode(levels.astype("u1").tobytes())
+            nonzero = np.flatnonzero(values)
+            exact = json.dumps(
+                {
+                    "indexes": base64.b64encode(
+                        nonzero.astype("<u4").tobytes()
+                    ).decode("ascii"),
+                    "values": base64.b64encode(
+                        values.ravel()[nonzero].astype("<f4").tobytes()
+                    ).decode("ascii"),
+                }
+            )
+            manifest.update(
+                {
+                    "dtype": "uint8",
+                    "zmin": float(zmin),
+                    "zmax": float(zmax),
+                    "exact": int(len(nonzero)),
+                }
+            )
+        else:
+            abundances = base64.b64encode(relAbund.to_numpy(dtype="<f4").tobytes())
+        abundances = abundances.decode("ascii")
+        manifest = json.dumps(manifest)
+        relAbundOrder = "[" + ", ".join([str(x) for x in relAbundOrder]) + "]\n"
+
+    htmlTemplate = opts["lookup"].get_template("countTable.html")
+    jsTemplate = opts["lookup"].get_template("countTable.js")
+    data = "["
+    if len(asvIDs) > 0:
+        xAxes += """xaxis2: {
                 ticktext: xTopValues,
                 tickvals: xTickPos,
                 tickfont: {color: "#333"},
@@ -996,7 +1346,7 @@ def createAsvHeatmaps(pw):
                 linecolor: '#333',
     linewidth: 1,
             },"""
-            data += """{  // second trace for top x-axis
+        data += """{  // second trace for top x-axis
                        x: xTopValues,
                        y: yValues,
                        z: zValues,
@@ -1006,12 +1356,12 @@ def createAsvHeatmaps(pw):
                         showscale: false,
                        xaxis: 'x2',
                        hoverinfo: "text",
-                   text: zValues.map((row, i) => row.map((item, j) => {
-                       return "Sample: " + yValues[i] + "<br>" + xTopValues[j] + "<br>Taxon: " + xBotValues[j] + "<br>Rel. abundance: " + item;
+                   text: zValues.map((row, i) => Array.from(row, (_, j) => {
+                       return "Sample: " + yValues[i] + "<br>" + xTopValues[j] + "<br>Taxon: " + xBotValues[j] + "<br>Rel. abundance: " + zValues.exact(i, j).toFixed(zManifest.digits);
                        }))
                    },"""
-        if len(taxa) > 0:
-            xAxes += """xaxis: {
+    if len(taxa) > 0:
+        xAxes += """xaxis: {
                 ticktext: xBotValues,
                 tickvals: xTickPos,
                 tickfont: {color: "#333"},
@@ -1023,7 +1373,7 @@ def createAsvHeatmaps(pw):
                 linecolor: '#333',
     linewidth: 1,
             },"""
-            data += """{
+        data += """{
             x: xBotValues,
             y: yValues,
             z: zValues,
@@ -1032,18 +1382,32 @@ def createAsvHeatmaps(pw):
             colorscale: 'Viridis',
             showscale: false,
             hoverinfo: "text",
-        text: zValues.map((row, i) => row.map((item, j) => {
-            return "Sample: " + yValues[i] + "<br>Taxon: " + xBotValues[j] + "<br>Rel. abundance: " + item;
+        text: zValues.map((row, i) => Array.from(row, (_, j) => {
+            return "Sample: " + yValues[i] + "<br>Taxon: " + xBotValues[j] + "<br>Rel. abundance: " + zValues.exact(i, j).toFixed(zManifest.digits);
             }))
         },"""
-        if len(taxa) == 0 and len(asvIDs) == 0:
-            print(
-                "WARNING: Abundance tables did not have headers. Plotting might be broken."
+    if len(taxa) == 0 and len(asvIDs) == 0:
+        print(
+            "WARNING: Abundance tables did not have headers. Plotting might be broken."
+        )
+    data += "]"
+
+    # Files written to REPORT (relative to it), for the section cache
+    files = [os.path.basename(file)]
+    tiles = None
+    if not args.plotly:
+        dfar = relAbund.to_numpy()
+        if args.webgl:
+            # drawn in the browser from the matrix, on the colorbar's range
+            heatmapFilepath = None
+        elif args.tiles:
+            tiles, tileFiles = tilePyramid(
+                dfar, pw.res("img/heatmap-" + str(heatmapNbr))
             )
-        data += "]"
-
-        if not args.plotly:
-            dfar = relAbund.to_numpy()
+            files += [pw.relToRep(path) for path in tileFiles]
+            tiles = json.dumps(tiles)
+            heatmapFilepath = None
+        else:
             heatmapFilepath = os.path.join(
                 pw.pd,
                 "REPORT",
@@ -1053,71 +1417,165 @@ def createAsvHeatmaps(pw):
             )
             mpl.pyplot.imsave(heatmapFilepath, dfar)
             heatmapFilepath = pw.relToRep(heatmapFilepath)
-            legendFilepath = pw.relToRep(
-                colorbar(
-                    pw.res("img/heatmap-" + str(heatmapNbr) + "_colorbar.png"), relAbund
-                )
-            )
-            xBots = xaxis(
-                pw.res("img/heatmap-" + str(heatmapNbr) + "_xaxisbot"),
-                taxa,
-                "Assigned taxon",
-                "bottom",
-            )
-            xBots = [pw.relToRep(path) for path in xBots]
-            xTops = xaxis(
-                pw.res("img/heatmap-" + str(heatmapNbr) + "_xaxistop"),
-                asvIDs,
-                "Amplicon Sequence Variant",
-                "top",
-            )
-            xTops = [pw.relToRep(path) for path in xTops]
-            yLefts = yaxis(
-                pw.res("img/heatmap-" + str(heatmapNbr) + "_yaxis"), sampleIDs, ""
-            )
-            yLefts = [pw.relToRep(path) for path in yLefts]
-        else:
-            heatmapFilepath = None
-            legendFilepath = None
-            yLefts = None
-            xTops = None
-            xBots = None
-
-        html += (
-            htmlTemplate.render(
-                active=active,
-                hmNbr=heatmapNbr,
-                legendFilepath=legendFilepath,
-                yaxisImages=yLefts,
-                xaxisTopImages=xTops,
-                heatmap=heatmapFilepath,
-                xaxisBotImages=xBots,
-                title=title,
-                tbody=tbody,
-                isAsvTable=len(asvIDs) > 0,
-                plotly=args.plotly,
-                form=form,
+            files.append(heatmapFilepath)
+        legendFilepath = pw.relToRep(
+            colorbar(
+                pw.res("img/heatmap-" + str(heatmapNbr) + "_colorbar.png"), relAbund
             )
-            + "\n"
         )
-        if args.plotly:
-            js += jsTemplate.render(
-                abundances=data_str,
-                taxa=", ".join(taxa),
-                asvs=", ".join(asvIDs),
-                samples=", ".join(sampleIDs),
-                nCol=nCol,
-                xAxes=xAxes,
-                data=data,
-                zmin=zmin,
-                zmax=zmax,
-                height=(15 * len(sampleIDs) + 250 + topMargin),
-                topmargin=topMargin,
-                keyTopMargin=topMargin - 20,
-                hmNbr=heatmapNbr,
-            )
+        xBots = xaxis(
+            taxa,
+            "Assigned taxon",
+            "bottom",
+        )
+        xBots = [pw.relToRep(path) for path in xBots]
+        xTops = xaxis(
+            asvIDs,
+            "Amplicon Sequence Variant",
+            "top",
+        )
+        xTops = [pw.relToRep(path) for path in xTops]
+        yLefts = yaxis(sampleIDs, "")
+        yLefts = [pw.relToRep(path) for path in yLefts]
+        files += [legendFilepath] + xBots + xTops + yLefts
+    else:
+        heatmapFilepath = None
+        legendFilepath = None
+        yLefts = None
+        xTops = None
+        xBots = None
+
+    html = (
+        htmlTemplate.render(
+            active=active,
+            hmNbr=heatmapNbr,
+            legendFilepath=legendFilepath,
+            yaxisImages=yLefts,
+            xaxisTopImages=xTops,
+            heatmap=heatmapFilepath,
+            tiles=tiles,
+            webgl=args.webgl,
+            shape=relAbund.shape,
+            xaxisBotImages=xBots,
+            title=title,
+            tbody=tbody,
+            isAsvTable=len(asvIDs) > 0,
+            plotly=args.plotly,
+            form=form,
+        )
+        + "\n"
+    )
+    js = ""
+    if args.plotly:
+        js = jsTemplate.render(
+            abundances=abundances,
+            manifest=manifest,
+            exact=exact,
+            taxa=", ".join(taxa),
+            asvs=", ".join(asvIDs),
+            samples=", ".join(sampleIDs),
+            nCol=nCol,
+            xAxes=xAxes,
+            data=data,
+            zmin=zmin,
+            zmax=zmax,
+            height=(15 * len(sampleIDs) + 250 + topMargin),
+            topmargin=topMargin,
+            keyTopMargin=topMargin - 20,
+            hmNbr=heatmapNbr,
+        )
+    elif args.webgl:
+        # The colors of the image heatmaps: the default colormap's 256 RGBA
+        # colors, spread over the range of the matrix
+        colormap = plt.get_cmap()(np.arange(256), bytes=True)
+        glTemplate = opts["lookup"].get_template("countTableGl.js")
+        js = glTemplate.render(
+            abundances=abundances,
+            manifest=manifest,
+            exact=exact,
+            colormap=base64.b64encode(colormap.tobytes()).decode("ascii"),
+            vmin=float(relAbund.min().min()),
+            vmax=float(relAbund.max().max()),
+            taxa=", ".join([enquote(taxon) for taxon in taxa]),
+            asvs=", ".join([enquote(asvID) for asvID in asvIDs]),
+            samples=", ".join([enquote(id) for id in sampleIDs]),
+            hmNbr=heatmapNbr,
+        )
+    files = [os.path.join(pw.pd, "REPORT", path) for path in files]
+    return {"html": html, "js": js, "files": files}
+
+
+# Sets up a worker process of createAsvHeatmaps' pool like the main process, which
+# spawned workers (e.g. on macOS) would otherwise be missing
+def initHeatmapWorker(workerPw, workerArgs, workerScriptDir, contaminants):
+    global pw, args, scriptDir
+    pw = workerPw
+    args = workerArgs
+    scriptDir = workerScriptDir
+    opts["contaminants"] = contaminants
+    opts["lookup"] = TemplateLookup(directories=[scriptDir], strict_undefined=True)
 
-        heatmapNbr += 1
+
+def createAsvHeatmaps(pw):
+    os.chdir(pw.pd)
+
+    tables = [
+        (file, opts["asvDfs"][file], heatmapNbr)
+        for heatmapNbr, file in enumerate(opts["asvDfs"].keys(), start=1)
+    ]
+    # Only tables whose heatmap section can't be reused are rendered
+    fingerprints = [
+        sectionFingerprint(
+            "heatmap-" + str(heatmapNbr),
+            [
+                file,
+                pw.script("countTable.html"),
+                pw.script("countTable.js"),
+                pw.script("countTableGl.js"),
+            ],
+            [
+                file,
+                heatmapNbr,
+                args.plotly,
+                args.webgl,
+                args.quantize,
+                args.tiles,
+                args.tile_pooling,
+                args.max_columns,
+                sorted(opts["contaminants"]),
+                mpl.__version__,
+            ],
+        )
+        for file, df, heatmapNbr in tables
+    ]
+    rendered = [
+        loadSection("heatmap-" + str(table[2]), fingerprint)
+        for table, fingerprint in zip(tables, fingerprints)
+    ]
+    missing = [i for i, fragments in enumerate(rendered) if fragments is None]
+    if args.jobs > 1 and len(missing) > 1:
+        # Each table's images and fragments are rendered in a worker; starmap
+        # returns them in the original table order
+        with multiprocessing.Pool(
+            min(args.jobs, len(missing)),
+            initializer=initHeatmapWorker,
+            initargs=(pw, args, scriptDir, opts["contaminants"]),
+        ) as pool:
+            built = pool.starmap(createAsvHeatmap, [tables[i] for i in missing])
+    else:
+        built = [createAsvHeatmap(*tables[i]) for i in missing]
+    for i, fragments in zip(missing, built):
+        files = fragments.pop("files")
+        storeSection("heatmap-" + str(tables[i][2]), fingerprints[i], fragments, files)
+        rendered[i] = fragments
+
+    html = "".join([fragments["html"] for fragments in rendered])
+    # Only the Plotly and WebGL heatmaps have data to load
+    js = {
+        "heatmap-" + str(table[2]): fragments["js"]
+        for table, fragments in zip(tables, rendered)
+        if len(fragments["js"]) > 0
+    }
 
     sectionTemplate = opts["lookup"].get_template("countPage.html")
     selectorOpts = ""
@@ -1244,6 +1702,20 @@ def getCtrlPlots(pw, pars):
     if pars.prefix == "pcrNeg":
         opts["contaminants"] = asvIDs
 
+    # With --max-columns, the ASVs or taxa after the most abundant ones are summed
+    # into a single "Other" bar. Contaminants are still marked in every heatmap
+    if args.max_columns is not None and len(data.columns) > args.max_columns:
+        other = data.iloc[:, args.max_columns :].sum(axis=1)
+        data = pd.DataFrame(
+            np.column_stack([data.iloc[:, : args.max_columns].to_numpy(), other]),
+            index=data.index,
+        )
+        sems = sems[: args.max_columns] + [other.sem() / math.sqrt(len(ctrls))]
+        if len(taxa) > 0:
+            taxa = taxa[: args.max_columns] + ["Other"]
+        if len(asvIDs) > 0:
+            asvIDs = asvIDs[: args.max_columns] + ["Other"]
+
     html_template = opts["lookup"].get_template(pars.prefix + "CtrlPlot.html")
     sample_names = data.index.values.tolist()
     options = ["<option>" + name + "</option>" for name in sample_names]
@@ -1280,124 +1752,261 @@ def colorbar(file, data):
     return os.path.abspath(file)
 
 
-def xaxis(filebase, ticklabels, title, topbot):
+# Lays text out the way matplotlib's Agg backend does, so that label extents
+# can be measured without building a figure. matplotlib caches each font file's
+# metrics; the extent of every label is cached here
+@functools.lru_cache(maxsize=None)
+def textRenderer(dpi):
+    return RendererAgg(1, 1, dpi)
+
+
+# (width, height) in pixels of a label set in the given font
+@functools.lru_cache(maxsize=None)
+def labelExtent(label, fontfile, fontsize, dpi):
+    w, h, d = textRenderer(dpi).get_text_width_height_descent(
+        label, fm.FontProperties(fname=fontfile, size=fontsize), ismath=False
+    )
+    return (w, h)
+
+
+# Inches from a strip's axis line to the far end of its longest tick label: the
+# tick mark and its pad, then the label, plus 5 px for the axis itself
+def stripDepth(ticklabels, fontfile, dpi, tickAxis):
+    tickOffset = (
+        mpl.rcParams[tickAxis + "tick.major.size"]
+        + mpl.rcParams[tickAxis + "tick.major.pad"]
+    ) / 72
+    longest = max(
+        [labelExtent(str(label), fontfile, 9, dpi)[0] for label in ticklabels],
+        default=0,
+    )
+    return tickOffset + (longest + 5) / dpi
+
+
+# Renders label strips or heatmap tiles with render(*item), in worker processes
+# with --jobs (unless this already is a worker, which can't start its own)
+def renderInWorkers(render, items):
+    if (
+        args.jobs > 1
+        and len(items) > 1
+        and not multiprocessing.current_process().daemon
+    ):
+        with multiprocessing.Pool(min(args.jobs, len(items))) as pool:
+            return pool.starmap(render, items)
+    return [render(*item) for item in items]
+
+
+TILE_SIZE = 256
+
+
+# Cuts a heatmap into a pyramid of PNG tiles of up to TILE_SIZE x TILE_SIZE pixels,
+# saved as directory/<level>/<row>_<column>.png. Level 0 has a pixel per cell, and
+# each further level pools 2 x 2 pixels of the one below (their maximum or mean,
+# per --tile-pooling) until a single tile holds the whole heatmap. Tiles are
+# colored on the range of the whole matrix, like the single-image heatmap.
+# Returns the pyramid's description for the viewer in data.js and the tile files
+def tilePyramid(matrix, directory):
+    pool = np.nanmax if args.tile_pooling == "max" else np.nanmean
+    levels = [matrix]
+    while max(levels[-1].shape) > TILE_SIZE:
+        level = levels[-1]
+        # an odd last row or column is pooled on its own
+        padded = np.full(
+            (level.shape[0] + level.shape[0] % 2, level.shape[1] + level.shape[1] % 2),
+            np.nan,
+        )
+        padded[: level.shape[0], : level.shape[1]] = level
+        blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2)
+        levels.append(pool(blocks, axis=(1, 3)))
+
+    vmin = matrix.min()
+    vmax = matrix.max()
+    tiles = []
+    for i, level in enumerate(levels):
+        os.makedirs(os.path.join(directory, str(i)), exist_ok=True)
+        for row in range(0, level.shape[0], TILE_SIZE):
+            for col in range(0, level.shape[1], TILE_SIZE):
+                name = str(row // TILE_SIZE) + "_" + str(col // TILE_SIZE) + ".png"
+                tiles.append(
+                    (
+                        os.path.join(directory, str(i), name),
+                        level[row : row + TILE_SIZE, col : col + TILE_SIZE],
+                        vmin,
+                        vmax,
+                    )
+                )
+    renderInWorkers(saveTile, tiles)
+
+    pyramid = {
+        "path": pw.relToRep(directory),
+        "rows": matrix.shape[0],
+        "columns": matrix.shape[1],
+        "levels": [list(level.shape) for level in levels],
+        "tileSize": TILE_SIZE,
+        "cellSize": 15,  # px per sample and per ASV, as for the axis labels
+    }
+    return pyramid, [tile[0] for tile in tiles]
+
+
+def saveTile(filepath, pixels, vmin, vmax):
+    mpl.pyplot.imsave(filepath, pixels, vmin=vmin, vmax=vmax)
+
+
+# SHA-256 of a file's contents, e.g. to tell whether a font has changed
+@functools.lru_cache(maxsize=None)
+def fileHash(filepath):
+    with open(filepath, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# Renders label strips with render(filepath, *strip) under names that address
+# their content (the renderer, labels, orientation, size, fonts and highlighted
+# labels), so a strip shared by several heatmaps is drawn once and referenced by
+# all of them. Strips are also kept in the axes directory of the cache, so a rebuild
+# of the report only draws strips it hasn't drawn before
+def cachedStrips(render, strips):
+    cacheDir = pw.cache("axes")
+    os.makedirs(cacheDir, exist_ok=True)
+
+    filepaths = []
+    missing = {}
+    for strip in strips:
+        # fonts are identified by their contents rather than their paths
+        key = [render.__name__, mpl.__version__] + [
+            fileHash(arg) if str(arg).endswith(".ttf") else arg for arg in strip
+        ]
+        key = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        filepath = pw.res("img/axis-" + key + ".png")
+        cached = os.path.join(cacheDir, key + ".png")
+        if not os.path.exists(filepath):
+            if os.path.exists(cached):
+                replaceFile(cached, filepath)
+            elif key not in missing:
+                missing[key] = (cached,) + tuple(strip)
+        filepaths.append(filepath)
+
+    for cached in renderInWorkers(render, list(missing.values())):
+        replaceFile(cached, pw.res("img/axis-" + os.path.basename(cached)))
+    return filepaths
+
+
+# Copies a file so that nobody (e.g. another worker) sees dest half-written
+def replaceFile(src, dest):
+    tmp = dest + "." + str(os.getpid()) + ".tmp"
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+# Saves the current figure through a temporary file, as another worker may be
+# saving the same strip
+def saveStrip(filepath):
+    tmp = filepath + "." + str(os.getpid()) + ".tmp"
+    plt.savefig(tmp, format="png")
+    plt.close("all")
+    os.replace(tmp, filepath)
+
+
+def renderXStrip(
+    filepath, ticklabels, topbot, dims, highlighted, fontfile, dpi, scalefactor
+):
+    prop = fm.FontProperties(fname=fontfile)
+    axismar = [0, 1, 1, 1 / dpi] if topbot == "bottom" else [0, 0, 1, 1 / dpi]
+    fig = plt.figure(figsize=dims)
+    ax = fig.add_axes(axismar)
+    ax.set(xlim=(0, dims[0] * dpi / scalefactor))
+    plt.xticks([x + 0.5 for x in range(len(ticklabels))])
+    ax.xaxis.set_ticks_position(topbot)
+    ax.xaxis.set_label_position(topbot)
+    ax.set_xticklabels(ticklabels, rotation=270, fontproperties=prop, fontsize=9)
+
+    for tickText in ax.get_xticklabels():
+        if tickText.get_text() in highlighted:
+            tickText.set_color("#f05f5e")
+
+    saveStrip(filepath)
+    return filepath
+
+
+def xaxis(ticklabels, title, topbot):
     dpi = 100  # matplotlib default
     scalefactor = 15  # we want 15px per label
     maxDim = 15000
     maxNPerImg = math.floor(maxDim / scalefactor)
-    filepaths = []
-    prop = fm.FontProperties(fname=pw.script("Open_Sans/OpenSans-Regular.ttf"))
-
-    def render(
-        ticklabels, nTicks, imgNbr
-    ):  # FIXME 1 more tick than label being rendered???
+    fontfile = pw.script("Open_Sans/OpenSans-Regular.ttf")
+    # print contaminants in red
+    highlighted = set(opts["contaminants"]) if topbot == "top" else set()
+
+    # Each strip is measured from the font metrics and drawn once at its final
+    # size: 15 px per tick across, deep enough for its longest label
+    strips = []
+    for start in range(0, len(ticklabels), maxNPerImg):
+        labels = ticklabels[start : start + maxNPerImg]
         dims = (
-            nTicks / dpi * scalefactor,
-            5,
-        )  # 150 in -> room for 150 / 15 * 100 = 1000 tickmarks
-        axismar = [0, 1, 1, 1 / dpi] if topbot == "bottom" else [0, 0, 1, 1 / dpi]
-        fig = plt.figure(figsize=dims)
-        ax = fig.add_axes(axismar)
-
-        ax.set(xlim=(0, dims[0] * dpi / scalefactor))
-        plt.xticks([x + 0.5 for x in range(nTicks)])
-        ax.xaxis.set_ticks_position(topbot)
-        ax.xaxis.set_label_position(topbot)
-        ax.set_xticklabels(ticklabels, rotation=270, fontproperties=prop, fontsize=9)
-
-        bbox = fig.get_tightbbox(fig.canvas.get_renderer())
-        bounds = bbox.bounds
-        plt.close("all")
-
-        dims = (dims[0], bounds[3])
-        fig = plt.figure(figsize=dims)
-        ax = fig.add_axes(axismar)
-        ax.set(xlim=(0, dims[0] * dpi / scalefactor))
-
-        plt.xticks([x + 0.5 for x in range(nTicks)])
-        ax.xaxis.set_ticks_position(topbot)
-        ax.xaxis.set_label_position(topbot)
-        ax.set_xticklabels(ticklabels, rotation=270, fontproperties=prop, fontsize=9)
-
-        if topbot == "top":  # print contaminants in red
-            tickTexts = ax.get_xticklabels()
-            for tickText in tickTexts:
-                if tickText.get_text() in opts["contaminants"]:
-                    tickText.set_color("#f05f5e")
-
-        dx = 5 / 100.0
-        dy = 0 / 100.0
-        # offset = ScaledTranslation(dx, dy, fig.dpi_scale_trans)
-        # # apply offset transform to all x ticklabels.
-        # if topbot == "top":
-        #     for label in ax.xaxis.get_majorticklabels():
-        #         label.set_transform(label.get_transform() + offset)
-
-        filepath = os.path.abspath(filebase + "-" + str(imgNbr) + ".png")
-        plt.savefig(filepath)
-        plt.close("all")
-        return filepath
-
-    i = 0
-    while i < math.floor(len(ticklabels) / maxNPerImg):
-        filepaths.append(render(ticklabels[i * 1000 : (i + 1) * 1000], maxNPerImg, i))
-        i += 1
-    nTicks = len(ticklabels) - i * 1000
-    if nTicks > 0:
-        filepaths.append(render(ticklabels[i * 1000 : len(ticklabels)], nTicks, i))
-    return filepaths
+            len(labels) / dpi * scalefactor,
+            stripDepth(labels, fontfile, dpi, "x"),
+        )
+        strips.append(
+            (
+                labels,
+                topbot,
+                dims,
+                sorted(highlighted.intersection(labels)),
+                fontfile,
+                dpi,
+                scalefactor,
+            )
+        )
+    return cachedStrips(renderXStrip, strips)
 
 
-def yaxis(filebase, ticklabels, title):
-    filepaths = []
+def renderYStrip(
+    filepath, ticklabels, title, dims, fontfile, boldfontfile, dpi, scalefactor
+):
+    prop = fm.FontProperties(fname=fontfile)
+    propBold = fm.FontProperties(fname=boldfontfile)
+    axismar = [1, 0, 1 / dpi, 1]
+    fig = plt.figure(figsize=dims)
+    ax = fig.add_axes(axismar)
+    ax.set_ylabel(title, fontproperties=propBold, fontsize=10.5)
+    ax.set(ylim=(0, dims[1] * dpi / scalefactor))
+    plt.gca().invert_yaxis()
+    plt.yticks([x + 0.5 for x in range(len(ticklabels))])
+    ax.yaxis.set_ticks_position("left")
+    ax.yaxis.set_label_position("left")
+    ax.set_yticklabels(ticklabels, fontproperties=prop, fontsize=9)
+    saveStrip(filepath)
+    return filepath
+
+
+def yaxis(ticklabels, title):
     dpi = 100  # matplotlib default
     maxDim = 15000
     scalefactor = 15  # we want 15px per label
     maxNPerImg = math.floor(maxDim / scalefactor)
-    prop = fm.FontProperties(fname=pw.script("Open_Sans/OpenSans-Regular.ttf"))
-    propBold = fm.FontProperties(fname=pw.script("Open_Sans/OpenSans-Bold.ttf"))
-
-    def render(ticklabels, nTicks, imgNbr):
-        dims = (
-            5,
-            nTicks / (dpi / scalefactor),
-        )  # 150 in -> room for 150 / 15 * 100 = 1000 tickmarks
-        axismar = [1, 0, 1 / dpi, 1]
-        fig = plt.figure(figsize=dims)
-        ax = fig.add_axes(axismar)
-        ax.set_ylabel(title, fontproperties=propBold, fontsize=10.5)
-        ax.set(ylim=(0, dims[1] * (dpi / scalefactor)))
-        plt.yticks([y + 0.5 for y in range(nTicks)])
-        ax.yaxis.set_ticks_position("left")
-        ax.yaxis.set_label_position("left")
-        ax.set_yticklabels(ticklabels, fontproperties=prop, fontsize=9)
-        bbox = fig.get_tightbbox(fig.canvas.get_renderer())
-        bounds = bbox.bounds
-        plt.close("all")
-        # plot again with updated figure dimensions
-        dims = (bounds[2], dims[1])
-        fig = plt.figure(figsize=dims)
-        ax = fig.add_axes(axismar)
-        ax.set_ylabel(title, fontproperties=propBold, fontsize=10.5)
-        ax.set(ylim=(0, dims[1] * dpi / scalefactor))
-        plt.gca().invert_yaxis()
-        plt.yticks([x + 0.5 for x in range(nTicks)])
-        ax.yaxis.set_ticks_position("left")
-        ax.yaxis.set_label_position("left")
-        ax.set_yticklabels(ticklabels, fontproperties=prop, fontsize=9)
-        filepath = os.path.abspath(filebase + "-" + str(imgNbr) + ".png")
-        plt.savefig(filepath)
-        plt.close("all")
-        return filepath
-
-    i = 0
-    while i < math.floor(len(ticklabels) / maxNPerImg):
-        filepaths.append(render(ticklabels[i * 1000 : (i + 1) * 1000], maxNPerImg, i))
-        i += 1
-    nTicks = len(ticklabels) - i * 1000
-    if nTicks > 0:
-        filepaths.append(render(ticklabels[i * 1000 : len(ticklabels)], nTicks, i))
-    return filepaths
+    fontfile = pw.script("Open_Sans/OpenSans-Regular.ttf")
+    boldfontfile = pw.script("Open_Sans/OpenSans-Bold.ttf")
+
+    strips = []
+    for start in range(0, len(ticklabels), maxNPerImg):
+        labels = ticklabels[start : start + maxNPerImg]
+        width = stripDepth(labels, fontfile, dpi, "y")
+        if len(title) > 0:  # the axis title is set sideways beside the labels
+            width += (
+                labelExtent(title, boldfontfile, 10.5, dpi)[1] / dpi
+                + mpl.rcParams["axes.labelpad"] / 72
+            )
+        strips.append(
+            (
+                labels,
+                title,
+                (width, len(labels) / (dpi / scalefactor)),
+                fontfile,
+                boldfontfile,
+                dpi,
+                scalefactor,
+            )
+        )
+    return cachedStrips(renderYStrip, strips)
 
 
 def minifyCss(pw):
@@ -1458,7 +2067,52 @@ PROJECT
     parser.add_argument(
         "--plotly",
         action="store_true",
-        help="Use Plotly for heatmaps. Not recommended for HiSeq-size projects.",
+        help="Use Plotly for heatmaps. Not recommended for HiSeq-size projects; see --webgl.",
+    )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="With --plotly or --webgl, send heatmap colors as 8-bit levels between each table's lowest and highest relative abundance, plus the exact values of the non-zero cells for the hover text. Shrinks the report's data for large, sparse tables.",
+    )
+    parser.add_argument(
+        "--webgl",
+        action="store_true",
+        help="Draw each heatmap on a WebGL canvas instead of as an image: the matrix is sent to the graphics card once and colored there, and hovering over a cell shows its sample, ASV, taxon and relative abundance. The axes and colorbar are the images used without --plotly. For interactive heatmaps of HiSeq-size projects, which --plotly is too slow for.",
+    )
+    parser.add_argument(
+        "--tiles",
+        action="store_true",
+        help="Cut each heatmap into a pyramid of 256-px tiles at several zoom levels, of which the report only loads those in view. For HiSeq-size projects, whose heatmaps are too large for a single image. Can't be combined with --plotly",
+    )
+    parser.add_argument(
+        "--tile-pooling",
+        choices=["max", "mean"],
+        default="max",
+        help="How the zoomed-out levels of --tiles combine 2 x 2 pixels: max keeps a single abundant cell visible, mean shows the average. Default: max",
+    )
+    parser.add_argument(
+        "--max-columns",
+        metavar="N",
+        type=int,
+        help="Show only the N most abundant ASVs or taxa of each table in its heatmap and summary, and of the controls in their plots, with the rest summed into an Other column. Default: all",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Render the heatmaps of up to N count tables at once, in worker processes. Default: 1",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Build every section of the report again, instead of reusing the sections of the last build whose inputs haven't changed",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="DIR",
+        help="Keep what can be reused by the next build of the report (parsed count tables, axis labels and report sections) in DIR/<project directory name>. Default: .report_cache in the project directory",
     )
     parser.add_argument(
         "--project",
@@ -1476,6 +2130,13 @@ PROJECT
     if not args.interactive and args.runs is None:
         print("Requires either --interactive or --runs")
         sys.exit(1)
+    if args.max_columns is not None and args.max_columns < 1:
+        print("--max-columns must be at least 1")
+        sys.exit(1)
+    if args.tiles and args.plotly:
+        parser.error("--tiles can't be combined with --plotly")
+    if args.webgl and (args.plotly or args.tiles):
+        parser.error("--webgl can't be combined with --plotly or --tiles")
     if args.verbose:
         if not sys.warnoptions:
             import warnings
@@ -1487,9 +2148,15 @@ PROJECT
         config = json.load(fh)
 
     for wd in args.wd:
-        pw = Pathwiz(
-            scriptsDir=scriptDir, projectDir=os.path.abspath(os.path.expanduser(wd))
-        )
+        projectDir = os.path.abspath(os.path.expanduser(wd))
+        if args.cache_dir is not None:
+            cacheDir = os.path.join(
+                os.path.abspath(os.path.expanduser(args.cache_dir)),
+                os.path.basename(projectDir),
+            )
+        else:
+            cacheDir = os.path.join(projectDir, ".report_cache")
+        pw = Pathwiz(scriptsDir=scriptDir, projectDir=projectDir, cacheDir=cacheDir)
         for run in args.runs:
             if not os.path.isdir(pw.proj(run)):
                 print("Cannot find " + pw.proj(run) + "\n")
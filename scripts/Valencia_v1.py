@@ -6,9 +6,12 @@
 import pandas as pd
 import numpy as np
 import sys
-
-#removing the  warning that pandas has for when you do complicated things
-pd.options.mode.chained_assignment = None  # default='warn'
+import os
+import hashlib
+import zipfile
+import contextlib
+import multiprocessing
+import sqlite3
 
 #!/usr/bin/python
 
@@ -52,7 +55,76 @@ def yue_distance(row, median):
     yue_med_dist = product / (diff_sq + product)
      
     #return the value of yue distance
-    return yue_med_dist 
+    return yue_med_dist
+
+#largest difference from the float64 scores allowed with dtype=np.float32: relative abundances and products
+#carry about 7 significant digits in single precision, which leaves the similarity scores within ~2e-6 of
+#double precision on the bundled centroids; CST calls can only change for a sample whose two best subCSTs
+#are closer than this
+FLOAT32_TOLERANCE = 1e-5
+
+#defining function to determine yue-clayton theta of every sample against every centroid at once
+#same result as yue_distance applied row by row, but as a handful of matrix products
+#centroid_extra_sq is sum q^2 over any centroid taxa left out of both matrices (where p is 0)
+#dtype is the precision the matrices are held and multiplied in, see FLOAT32_TOLERANCE
+def yue_similarity_matrix(sample_rel, centroids, centroid_extra_sq=0, dtype=np.float64):
+
+    #samples x taxa and centroids x taxa, with the taxa in the same order
+    sample_rel = np.asarray(sample_rel, dtype=dtype)
+    centroids = np.asarray(centroids, dtype=dtype)
+
+    #nansum skips any term where either abundance is missing, so remember where values were observed
+    #and zero out the rest
+    sample_obs = ~np.isnan(sample_rel)
+    centroid_obs = ~np.isnan(centroids)
+    sample_rel = np.where(sample_obs, sample_rel, 0)
+    centroids = np.where(centroid_obs, centroids, 0)
+
+    #calculate sum p * q for every sample/centroid pair
+    product = sample_rel @ centroids.T
+
+    #calculate sum p-q squared, expanded as p^2 - 2pq + q^2 over the taxa observed in both
+    diff_sq = (sample_rel ** 2) @ centroid_obs.T.astype(dtype) + sample_obs.astype(dtype) @ (centroids ** 2).T - 2 * product
+    diff_sq += centroid_extra_sq
+    #the expansion can leave tiny negative rounding errors where p == q
+    np.maximum(diff_sq, 0, out=diff_sq)
+
+    #calculate yue_med_dist, leaving nan where nothing was observed (as yue_distance does)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return product / (diff_sq + product)
+
+#defining function to determine yue-clayton theta for a sparse (e.g. scipy CSR) samples x taxa matrix of
+#read counts, against compiled Centroids; only the non-zero counts are ever touched
+def sparse_yue_similarity_matrix(counts, taxa, centroids, dtype=np.float64):
+
+    counts = counts.tocsr()
+    read_count = np.asarray(counts.sum(axis=1), dtype=np.float64).ravel()
+
+    #converting the read counts to relative abundances, samples without reads stay empty
+    scale = np.zeros(read_count.shape)
+    np.divide(1, read_count, out=scale, where=read_count > 0)
+    sample_rel = counts.multiply(scale[:, np.newaxis]).tocsr().astype(dtype)
+
+    #centroid abundance of every sample taxon, 0 where the centroids don't have it
+    centroid_rel, _ = centroids.align(taxa)
+    centroid_rel = centroid_rel.astype(dtype)
+
+    #calculate sum p * q for every sample/centroid pair
+    product = np.asarray(sample_rel @ centroid_rel.T)
+
+    #calculate sum p-q squared as sum p^2 + sum q^2 - 2 sum p * q, so taxa seen on only one side
+    #still count without densifying the samples
+    sample_sq = np.asarray(sample_rel.multiply(sample_rel).sum(axis=1)).ravel()
+    diff_sq = sample_sq[:, np.newaxis] + centroids.sq.astype(dtype)[np.newaxis, :] - 2 * product
+    np.maximum(diff_sq, 0, out=diff_sq)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        similarity = product / (diff_sq + product)
+
+    #samples without reads have nothing to compare, as in yue_distance
+    similarity[~(read_count > 0)] = np.nan
+
+    return similarity
 
 #### defining fuction to determine the penalized similarity score
 def penalized_simil_score(row):
@@ -76,66 +148,436 @@ def penalized_simil_score(row):
 
     return penalized_score
 
-#list of subCSTs 
+#### defining function to determine the penalized similarity score of every sample at once
+#same result as penalized_simil_score applied row by row, returns the index of the most similar subCST
+#(-1 for samples without any similarity), the penalized score and the top similarity score
+def penalized_simil_scores(similarity, subCSTs):
+
+    similarity = np.asarray(similarity)
+    rows = np.arange(similarity.shape[0])
+
+    #samples without reads have no similarity to anything and get no call
+    unscored = np.isnan(similarity).all(axis=1)
+    filled = np.where(np.isnan(similarity), -np.inf, similarity)
+
+    #finding the most similar subCST for each sample
+    best = filled.argmax(axis=1)
+    score = filled[rows, best]
+
+    #masking out the sister of the most similar subCST (I-A/I-B, III-A/III-B)
+    sisters = np.array([subCSTs.index(sister_subCSTs[subCST]) if subCST in sister_subCSTs else -1 for subCST in subCSTs])
+    best_sister = sisters[best]
+    has_sister = best_sister >= 0
+    filled[rows[has_sister], best_sister[has_sister]] = -np.inf
+
+    #only the top two remaining scores matter, so partially sort instead of sorting every row
+    top_two = np.partition(filled, -2, axis=1)[:, -2:]
+    with np.errstate(invalid='ignore'):
+        penalized_score = top_two[:, 1] * (top_two[:, 1] - top_two[:, 0]) ** (1./2)
+
+    best[unscored] = -1
+    score[unscored] = np.nan
+    penalized_score[unscored] = np.nan
+
+    return best, penalized_score, score
+
+#list of subCSTs
 CSTs = ['I-A','I-B','II','III-A','III-B','IV-A','IV-B','IV-C0','IV-C1','IV-C2','IV-C3','IV-C4','V']
 
-#reading in the input CST centroids
-reference_centroids = pd.read_csv(sys.argv[1],sep=',')
+#subCSTs too similar to each other to penalize a sample for resembling both
+sister_subCSTs = {'I-A':'I-B','I-B':'I-A','III-A':'III-B','III-B':'III-A'}
+
+#collapsing subCSTs into CSTs
+subCST_to_CST = {'I-A':'I','I-B':'I','III-A':'III','III-B':'III','IV-C0':'IV-C','IV-C1':'IV-C','IV-C2':'IV-C','IV-C3':'IV-C','IV-C4':'IV-C'}
+
+#looking up subCST and CST names by index, the trailing nan is picked up by unscored samples (index -1)
+subCST_names = np.array(CSTs + [np.nan], dtype=object)
+CST_names = np.array([subCST_to_CST.get(CST, CST) for CST in CSTs] + [np.nan], dtype=object)
+
+#the columns CST_calls adds to a count table
+CST_call_columns = ['%s_sim' %(CST) for CST in CSTs] + ['sim_subCST', 'penalized_score', 'score', 'sim_CST']
+
+#turning a samples x CSTs similarity matrix into the *_sim scores and CST calls of each sample
+def CST_calls(similarity, index):
+
+    best, penalized_score, score = penalized_simil_scores(similarity, CSTs)
+
+    calls = pd.DataFrame(similarity, index=index, columns=CST_call_columns[:len(CSTs)])
+    calls['sim_subCST'] = subCST_names[best]
+    calls['penalized_score'] = penalized_score
+    calls['score'] = score
+    calls['sim_CST'] = CST_names[best]
+
+    return calls
+
+#CST centroids compiled for classification: a subCSTs x taxa matrix of relative abundances (rows in the order
+#of CSTs) and an index from taxon name to matrix column, so samples are matched to the centroids by name
+#without concatenating or realigning tables
+class Centroids(object):
+    def __init__(self, matrix, taxa):
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        self.taxa = list(taxa)
+        self.index = {taxon: i for i, taxon in enumerate(self.taxa)}
+        #sum q^2 of each centroid
+        self.sq = (self.matrix ** 2).sum(axis=1)
+        #identifies these centroids' contents, e.g. to tell cached similarity scores apart
+        self.fingerprint = hashlib.sha256(self.matrix.tobytes() + '\t'.join(self.taxa).encode()).hexdigest()
 
-#reading in table of samples to be tested against the centroids
-sample_data_OG = pd.read_csv(sys.argv[2],sep=',')
+    @classmethod
+    def from_frame(cls, centroids):
+        centroids = centroids.reindex(index=CSTs).fillna(0)
+        return cls(centroids.to_numpy(dtype=np.float64), centroids.columns)
 
-#forcing the sample data to have the same number of columns as the reference 
-combined_data = pd.concat([sample_data_OG,reference_centroids], ignore_index=True,sort=False)
-sample_data = combined_data[:-13].fillna(0)
-sample_data = sample_data.drop(['sub_CST'],axis=1)
-print(sample_data.shape)
+    #centroid abundances of the given taxa (CSTs x taxa, 0 for taxa the centroids don't have), and
+    #sum q^2 of each centroid over its taxa that weren't asked for
+    def align(self, taxa):
+        positions = np.array([self.index.get(taxon, -1) for taxon in taxa], dtype=np.intp)
+        found = positions >= 0
 
-reference_centroids = combined_data.tail(13).fillna(0)
+        aligned = np.zeros((self.matrix.shape[0], len(positions)))
+        aligned[:, found] = self.matrix[:, positions[found]]
 
-#reference_centroids = reference_centroids.drop(['sampleID','CST','Sample_number_for_SRA','barcode','Type','Project','total_reads'],axis=1).set_index('sub_CST')
-reference_centroids = reference_centroids.drop(["sampleID","read_count"],axis=1).set_index('sub_CST')
+        unmatched = np.ones(len(self.taxa), dtype=bool)
+        unmatched[positions[found]] = False
 
+        return aligned, (self.matrix[:, unmatched] ** 2).sum(axis=1)
 
-#converting all of the read counts to relative abundance data for use in determining community stability
-sample_data_rel = sample_data[sample_data.columns[2:]].div(sample_data['read_count'],axis=0)
+#accepting compiled Centroids or a table of centroids indexed by sub_CST
+def as_centroids(centroids):
 
-#sample_data_rel = sample_data[sample_data.columns[8:]].div(100,axis=0)
-sample_data_rel = pd.concat([sample_data[sample_data.columns[0:2]],sample_data_rel],axis=1)
-print(sample_data_rel)
-print(reference_centroids)
+    return centroids if isinstance(centroids, Centroids) else Centroids.from_frame(centroids)
 
-#activate this line if already converted to relative abundance
-#reference_input_rel = reference_input
-#print(sample_data_rel)
+#parsing the CST centroids CSV, one row of relative abundances per subCST
+def parse_centroids(path):
 
-for CST in CSTs:
+    return Centroids.from_frame(pd.read_csv(path, sep=',', index_col='sub_CST'))
 
-    sample_data_OG['%s_sim' %(CST)] = sample_data_rel.apply(lambda x : yue_distance(x[2:],reference_centroids.loc[CST]), axis=1)
+#reading in CST centroids
+#the parsed centroids are kept in a .npz next to the CSV and reused until the CSV's contents change
+def read_centroids(path):
 
-#outputting the acquired data with the new variability measure
-#print(sample_data.columns[-13:])
+    with open(path, 'rb') as fh:
+        source_hash = hashlib.sha256(fh.read()).hexdigest()
+    compiled_path = os.path.splitext(path)[0] + '.npz'
 
-sample_data_OG['sim_subCST'] = sample_data_OG.iloc[:,-13:].idxmax(axis=1)
-sample_data_OG['sim_subCST'] = sample_data_OG['sim_subCST'].str.replace('_sim',"")
-sample_data_OG['penalized_score'] = sample_data_OG.apply(lambda x : penalized_simil_score(x[-14:]), axis=1)
-sample_data_OG['score'] = sample_data_OG.iloc[:,-15:-2].max(axis=1)
+    try:
+        with np.load(compiled_path, allow_pickle=False) as compiled:
+            if str(compiled['source_sha256']) == source_hash:
+                return Centroids(compiled['matrix'], compiled['taxa'].tolist())
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        pass
 
+    centroids = parse_centroids(path)
 
-sample_data_OG['sim_CST'] = sample_data_OG['sim_subCST'].replace({'I-A':'I','I-B':'I','III-A':'III','III-B':'III','IV-C0':'IV-C','IV-C1':'IV-C','IV-C2':'IV-C','IV-C3':'IV-C','IV-C4':'IV-C'})
+    #writing to a temporary file first so concurrent runs never read a half-written file
+    temp_path = '%s.%d.tmp' %(compiled_path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as fh:
+            np.savez(fh, matrix=centroids.matrix, taxa=np.array(centroids.taxa, dtype=str), source_sha256=np.array(source_hash))
+        os.replace(temp_path, compiled_path)
+    except OSError:
+        #not being able to cache the centroids (e.g. read-only data directory) only costs a re-parse
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
 
-sample_data_OG.to_csv("%s_StR_CST.csv" %(sys.argv[2].split(".")[0]),index=None)
+    return centroids
 
+#splitting a count table into the read counts per taxon and the total reads per sample,
+#calculating the totals unless a read_count column gives them
+def split_read_count(counts_df):
 
+    if 'read_count' in counts_df.columns:
+        return counts_df.drop(['read_count'], axis=1), counts_df['read_count']
+    return counts_df, counts_df.sum(axis=1)
 
+#similarity of every sample in a table of read counts to every subCST centroid, samples x CSTs
+def similarity_to_centroids(counts, read_count, centroids, dtype=np.float64):
 
+    #converting all of the read counts to relative abundance data for use in determining community stability
+    sample_data_rel = counts.to_numpy(dtype=dtype, copy=True)
+    sample_data_rel[np.isnan(sample_data_rel)] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(sample_data_rel, read_count.fillna(0).to_numpy(dtype=dtype)[:, np.newaxis], out=sample_data_rel)
 
+    #looking up the centroid abundances of the sample's taxa, centroid taxa the samples don't have only add q^2
+    reference_centroids, centroid_extra_sq = centroids.align(counts.columns)
 
+    similarity = yue_similarity_matrix(sample_data_rel, reference_centroids, centroid_extra_sq, dtype)
 
+    #samples without reads have nothing to compare, as in yue_distance
+    similarity[~(read_count.fillna(0).to_numpy() > 0)] = np.nan
 
+    return similarity
+
+#adding read_count (if it isn't there yet), the similarity scores and the CST calls to a count table
+def add_CST_calls(counts_df, read_count, similarity):
+
+    if 'read_count' not in counts_df.columns:
+        counts_df = counts_df.copy()
+        counts_df.insert(0, 'read_count', read_count)
 
+    return pd.concat([counts_df, CST_calls(similarity, counts_df.index)], axis=1)
 
+#classifying samples against the CST centroids
+#counts_df has one row of read counts per sample (indexed by sample ID) and one column per taxon, and may
+#already carry a read_count column with each sample's total; centroids are compiled Centroids (from
+#read_centroids) or a table of centroids indexed by sub_CST. Returns counts_df with read_count, the similarity
+#scores and the CST calls, laid out like *_StR_CST.csv; dtype=np.float32 scores in single precision
+def classify(counts_df, centroids, dtype=np.float64):
+
+    counts, read_count = split_read_count(counts_df)
+    similarity = similarity_to_centroids(counts, read_count, as_centroids(centroids), dtype)
+
+    return add_CST_calls(counts_df, read_count, similarity)
+
+#compiled centroids of a worker process, attached from shared memory once when the worker starts
+worker_centroids = None
+
+def init_worker(shm_name, shape, taxa):
 
+    from multiprocessing import shared_memory
+
+    global worker_centroids, worker_shm
+    worker_shm = shared_memory.SharedMemory(name=shm_name)
+    worker_centroids = Centroids(np.ndarray(shape, dtype=np.float64, buffer=worker_shm.buf), taxa)
+
+def shard_similarity(shard):
+
+    counts, read_count, dtype = shard
+    return similarity_to_centroids(counts, read_count, worker_centroids, dtype)
+
+#starting a pool of worker processes that share one copy of the centroid matrix, instead of each task
+#getting its own pickled copy
+@contextlib.contextmanager
+def worker_pool(centroids, jobs):
+
+    from multiprocessing import shared_memory
+
+    centroids = as_centroids(centroids)
+    shm = shared_memory.SharedMemory(create=True, size=centroids.matrix.nbytes)
+    try:
+        shared = np.ndarray(centroids.matrix.shape, dtype=np.float64, buffer=shm.buf)
+        shared[:] = centroids.matrix
+        del shared
+        with multiprocessing.Pool(jobs, initializer=init_worker, initargs=(shm.name, centroids.matrix.shape, centroids.taxa)) as pool:
+            yield pool
+    finally:
+        shm.close()
+        shm.unlink()
+
+#similarity_to_centroids with the samples split into one shard per job and the shards scored by a
+#worker_pool; the rows come back in the original sample order
+def parallel_similarity(counts, read_count, pool, jobs, dtype=np.float64):
+
+    shards = [(counts.iloc[rows], read_count.iloc[rows], dtype) for rows in np.array_split(np.arange(len(counts)), jobs) if len(rows) > 0]
+    return np.vstack(pool.map(shard_similarity, shards)) if shards else np.empty((0, len(CSTs)), dtype=dtype)
+
+#classifying samples like classify, but scored by a worker_pool of that many jobs
+def classify_parallel(counts_df, pool, jobs, dtype=np.float64):
+
+    counts, read_count = split_read_count(counts_df)
+    return add_CST_calls(counts_df, read_count, parallel_similarity(counts, read_count, pool, jobs, dtype))
 
+#identifying each sample's counts: the taxa with reads, their counts and the total reads
+#(taxa without reads and the column order don't change a sample's similarity scores, so they don't change its hash)
+def sample_hashes(counts, read_count):
 
+    taxa = np.array([str(taxon) for taxon in counts.columns], dtype=object)
+    order = np.argsort(taxa, kind='stable')
+    taxa = taxa[order]
+    values = counts.to_numpy(dtype=np.float64)[:, order]
+    values[np.isnan(values)] = 0
+
+    hashes = []
+    for row, total in zip(values, read_count.fillna(0).to_numpy(dtype=np.float64)):
+        observed = np.flatnonzero(row)
+        sample_hash = hashlib.sha256('\t'.join(taxa[observed]).encode())
+        sample_hash.update(row[observed].tobytes())
+        sample_hash.update(np.float64(total).tobytes())
+        hashes.append(sample_hash.hexdigest())
+
+    return hashes
+
+#what cached scores are keyed by besides the sample: the centroids, and the precision when it isn't the default,
+#so single and double precision scores are never mixed
+def scoring_fingerprint(centroids, dtype=np.float64):
 
+    if np.dtype(dtype) == np.float64:
+        return centroids.fingerprint
+    return centroids.fingerprint + ':' + np.dtype(dtype).name
+
+#persistent store of similarity scores from earlier runs (an SQLite file), keyed by the hash of a sample's counts
+#and the fingerprint of the centroids; the CST calls are cheap to recompute from the scores so only those are kept
+class SimilarityCache(object):
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS similarity (sample_hash TEXT, centroids_hash TEXT, scores BLOB, PRIMARY KEY (sample_hash, centroids_hash))')
+        self.hits = 0
+        self.misses = 0
+
+    #stored scores of the given sample hashes, as a dict of hash to scores
+    def get(self, hashes, centroids_hash):
+        found = {}
+        unique_hashes = list(set(hashes))
+        #staying below SQLite's limit on query parameters
+        for i in range(0, len(unique_hashes), 500):
+            batch = unique_hashes[i:i + 500]
+            query = 'SELECT sample_hash, scores FROM similarity WHERE centroids_hash = ? AND sample_hash IN (%s)' %(','.join('?' * len(batch)))
+            for sample_hash, scores in self.db.execute(query, [centroids_hash] + batch):
+                found[sample_hash] = np.frombuffer(scores, dtype=np.float64)
+        return found
+
+    def put(self, hashes, centroids_hash, similarity):
+        self.db.executemany('INSERT OR REPLACE INTO similarity VALUES (?, ?, ?)', [(sample_hash, centroids_hash, np.asarray(scores, dtype=np.float64).tobytes()) for sample_hash, scores in zip(hashes, similarity)])
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+#scoring samples with score(counts, read_count), except those the cache already has scores for under centroids_hash
+#(see scoring_fingerprint)
+def cached_similarity(counts, read_count, score, cache, centroids_hash):
+
+    hashes = sample_hashes(counts, read_count)
+    found = cache.get(hashes, centroids_hash)
+
+    similarity = np.empty((len(hashes), len(CSTs)))
+    missing = []
+    for i, sample_hash in enumerate(hashes):
+        if sample_hash in found:
+            similarity[i] = found[sample_hash]
+        else:
+            missing.append(i)
+
+    if missing:
+        similarity[missing] = score(counts.iloc[missing], read_count.iloc[missing])
+        cache.put([hashes[i] for i in missing], centroids_hash, similarity[missing])
+
+    cache.hits += len(hashes) - len(missing)
+    cache.misses += len(missing)
+
+    return similarity
+
+#classifying samples given as a sparse (e.g. scipy CSR) samples x taxa matrix of read counts, with the sample
+#IDs and taxon names of its rows and columns; centroids as for classify.
+#Returns read_count, the similarity scores and the CST calls of each sample (not the counts themselves)
+def classify_sparse(counts, samples, taxa, centroids, dtype=np.float64):
+
+    similarity = sparse_yue_similarity_matrix(counts, taxa, as_centroids(centroids), dtype)
+
+    calls = CST_calls(similarity, pd.Index(samples))
+    calls.insert(0, 'read_count', np.asarray(counts.sum(axis=1)).ravel())
+
+    return calls
+
+#scoring samples with the centroids, for as long as the context is open: yields score(counts, read_count),
+#which returns the similarity of each sample to each subCST centroid; with more than one job, samples are
+#scored by that many worker processes; with a SimilarityCache, only samples it doesn't have are scored;
+#dtype=np.float32 scores in single precision (see FLOAT32_TOLERANCE)
+@contextlib.contextmanager
+def similarity_scorer(centroids, jobs=1, cache=None, dtype=np.float64):
+
+    centroids = as_centroids(centroids)
+
+    with contextlib.ExitStack() as stack:
+        if jobs > 1:
+            pool = stack.enter_context(worker_pool(centroids, jobs))
+            score = lambda counts, read_count: parallel_similarity(counts, read_count, pool, jobs, dtype)
+        else:
+            score = lambda counts, read_count: similarity_to_centroids(counts, read_count, centroids, dtype)
+
+        if cache is not None:
+            uncached_score = score
+            centroids_hash = scoring_fingerprint(centroids, dtype)
+            score = lambda counts, read_count: cached_similarity(counts, read_count, uncached_score, cache, centroids_hash)
+
+        yield score
+
+#classifying the samples in a count table file and writing them to output
+#with a chunksize, the table is read, classified and appended to output that many samples at a time,
+#so memory use depends on the chunk size instead of the number of samples; jobs, cache and dtype as for
+#similarity_scorer
+def classify_csv(table, centroids, output, chunksize=None, jobs=1, cache=None, dtype=np.float64):
+
+    with similarity_scorer(centroids, jobs, cache, dtype) as score:
+        write_classified(table, score, output, chunksize)
+
+#classifying several count table files with the centroids loaded (and any worker processes started) once,
+#writing each to its output as classify_csv does; with a CombinedWriter, the read_count, similarity scores and
+#CST calls of every table's samples also go to it as each chunk is classified, with the table each sample came
+#from in a source_table column
+def classify_csvs(tables, centroids, outputs, chunksize=None, jobs=1, cache=None, dtype=np.float64, combined=None):
+
+    with similarity_scorer(centroids, jobs, cache, dtype) as score:
+        for table, output in zip(tables, outputs):
+            if combined is None:
+                write_classified(table, score, output, chunksize)
+                continue
+
+            def write_calls(calls, table=table):
+                calls.insert(0, 'source_table', table)
+                combined.write(calls.rename_axis('sampleID'))
+
+            write_classified(table, score, output, chunksize, write_calls)
+
+#classifying a count table file a chunk at a time (or all at once without a chunksize) and writing it to output;
+#on_calls, if given, is passed the read_count, similarity scores and CST calls of each chunk
+def write_classified(table, score, output, chunksize, on_calls=None):
+
+    def classify_chunk(counts_df):
+        counts, read_count = split_read_count(counts_df)
+        classified = add_CST_calls(counts_df, read_count, score(counts, read_count))
+        if on_calls is not None:
+            #the calls are the last columns, looked up by position in case a taxon shares a call column's name
+            on_calls(pd.concat([read_count.rename('read_count'), classified.iloc[:, -len(CST_call_columns):]], axis=1))
+        return classified
+
+    if chunksize is None:
+        classify_chunk(pd.read_csv(table, sep=',', index_col=0)).to_csv(output)
+    else:
+        first_chunk = True
+        for chunk in pd.read_csv(table, sep=',', index_col=0, chunksize=chunksize):
+            classify_chunk(chunk).to_csv(output, mode='w' if first_chunk else 'a', header=first_chunk)
+            first_chunk = False
+
+#writing the calls of classify_csvs to one Parquet file (Feather if the path ends in .feather) as they come,
+#so only a chunk of them is ever in memory; the columns' types are set by the first chunk. Needs pyarrow
+class CombinedWriter(object):
+    def __init__(self, path):
+        self.path = path
+        self.feather = path.endswith('.feather')
+        self.schema = None
+        self.writer = None
+
+    def write(self, calls):
+        import pyarrow as pa
+
+        #Feather has no index, so the sample IDs become a column
+        if self.feather:
+            calls = calls.reset_index()
+        if self.writer is None:
+            self.schema = pa.Schema.from_pandas(calls, preserve_index=not self.feather)
+            #columns the first chunk has no values in (e.g. no sample with a call) can only hold strings
+            for i, field in enumerate(self.schema):
+                if pa.types.is_null(field.type):
+                    self.schema = self.schema.set(i, field.with_type(pa.string()))
+            if self.feather:
+                self.writer = pa.ipc.new_file(self.path, self.schema)
+            else:
+                import pyarrow.parquet
+                self.writer = pyarrow.parquet.ParquetWriter(self.path, self.schema)
+        self.writer.write_table(pa.Table.from_pandas(calls, schema=self.schema, preserve_index=not self.feather))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+if __name__ == '__main__':
+
+    #reading in the input CST centroids
+    reference_centroids = read_centroids(sys.argv[1])
+
+    #classifying the table of samples (sampleID, read_count, then read counts per taxon) against the centroids
+    classify_csv(sys.argv[2], reference_centroids, "%s_StR_CST.csv" %(sys.argv[2].split(".")[0]))
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+import sys, os, argparse, json, time, platform, resource
+import multiprocessing
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import Valencia_v1 as valencia
+
+ENGINES = ["legacy", "dense", "float32", "sparse", "parallel"]
+
+
+# Synthetic cohort shaped like the centroid file: every sample is a noisy copy of
+# a random subCST centroid, with a fraction of its taxa zeroed out
+def synthetic_counts(centroids, n_samples, sparsity, depth, seed):
+    rng = np.random.default_rng(seed)
+    profile = centroids.matrix[rng.integers(0, len(valencia.CSTs), n_samples)]
+    profile += rng.random(profile.shape) * 0.02
+    profile[rng.random(profile.shape) < sparsity] = 0
+    counts = rng.poisson(profile * depth).astype(np.int32)
+    return pd.DataFrame(
+        counts,
+        index=pd.Index(["sample" + str(i) for i in range(n_samples)], name="sampleID"),
+        columns=centroids.taxa,
+    )
+
+
+# The original Valencia path: yue_distance applied row by row for each subCST,
+# then penalized_simil_score applied row by row
+def legacy_similarity(counts, centroids):
+    read_count = counts.sum(axis=1)
+    sample_rel = counts.div(read_count, axis=0)
+    sims = pd.DataFrame(index=counts.index)
+    for i, cst in enumerate(valencia.CSTs):
+        median = centroids.matrix[i]
+        sims[cst + "_sim"] = sample_rel.apply(
+            lambda x: valencia.yue_distance(x.to_numpy(), median), axis=1
+        )
+    sims["sim_subCST"] = sims.idxmax(axis=1).str.replace("_sim", "")
+    sims["penalized_score"] = sims.apply(valencia.penalized_simil_score, axis=1)
+    return sims.iloc[:, : len(valencia.CSTs)].to_numpy(dtype=np.float64)
+
+
+# Puts the counts in the form the engine takes; not part of the timing
+def engine_input(engine, counts):
+    if engine == "sparse":
+        import scipy.sparse
+
+        return scipy.sparse.csr_matrix(counts.to_numpy())
+    return counts
+
+
+def run_engine(engine, data, counts, centroids, jobs):
+    if engine == "legacy":
+        return legacy_similarity(data, centroids)
+    if engine == "dense":
+        calls = valencia.classify(data, centroids)
+    elif engine == "float32":
+        calls = valencia.classify(data, centroids, np.float32)
+    elif engine == "sparse":
+        calls = valencia.classify_sparse(data, counts.index, counts.columns, centroids)
+    elif engine == "parallel":
+        with valencia.worker_pool(centroids, jobs) as pool:
+            calls = valencia.classify_parallel(data, pool, jobs)
+    return calls[[cst + "_sim" for cst in valencia.CSTs]].to_numpy(dtype=np.float64)
+
+
+# Peak RSS of this process, or with resource.RUSAGE_CHILDREN of the largest of its
+# children that have been waited for (e.g. the workers of a joined pool)
+def max_rss_mb(who=resource.RUSAGE_SELF):
+    rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+# Runs one case in a fresh process, so that its peak RSS is its own
+def run_case(case, centroids_path, jobs, keep_scores, results):
+    centroids = valencia.read_centroids(centroids_path)
+    counts = synthetic_counts(
+        centroids, case["samples"], case["sparsity"], case["depth"], case["seed"]
+    )
+    data = engine_input(case["engine"], counts)
+    rss_before = max_rss_mb()
+
+    start = time.perf_counter()
+    # the parallel engine's pool has been joined by the time this returns, so its
+    # workers show up in RUSAGE_CHILDREN
+    scores = run_engine(case["engine"], data, counts, centroids, jobs)
+    seconds = time.perf_counter() - start
+
+    results.put(
+        {
+            "seconds": seconds,
+            "samples_per_second": case["samples"] / seconds if seconds > 0 else None,
+            "rss_before_mb": rss_before,
+            "peak_rss_mb": max_rss_mb(),
+            # only the parallel engine has workers; other children (e.g. helpers run
+            # while importing scipy) would be misreported as such
+            "worker_peak_rss_mb": max_rss_mb(resource.RUSAGE_CHILDREN)
+            if case["engine"] == "parallel"
+            else None,
+            "scores": scores.tolist() if keep_scores else None,
+        }
+    )
+
+
+def main(args):
+    centroids = valencia.read_centroids(args.centroids)
+    context = multiprocessing.get_context("spawn")
+    report = {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "cpus": os.cpu_count(),
+        "centroids": os.path.abspath(args.centroids),
+        "taxa": len(centroids.taxa),
+        "jobs": args.jobs,
+        "cases": [],
+    }
+    # cases whose scores or calls drifted from the legacy engine's
+    failures = []
+
+    for n_samples in args.samples:
+        keep_scores = n_samples <= args.legacy_max_samples
+        legacy_scores = None
+        # legacy runs first so that the other engines can be compared against it
+        for engine in [engine for engine in ENGINES if engine in args.engines]:
+            if engine == "legacy" and n_samples > args.legacy_max_samples:
+                print("Skipping legacy engine for " + str(n_samples) + " samples")
+                continue
+            case = {
+                "engine": engine,
+                "samples": n_samples,
+                "sparsity": args.sparsity,
+                "depth": args.depth,
+                "seed": args.seed,
+            }
+            results = context.Queue()
+            worker = context.Process(
+                target=run_case,
+                args=(case, args.centroids, args.jobs, keep_scores, results),
+            )
+            worker.start()
+            result = results.get()
+            worker.join()
+
+            # How far each engine's scores are from the original implementation's
+            scores = result.pop("scores")
+            if scores is not None:
+                scores = np.array(scores, dtype=np.float64)
+                if engine == "legacy":
+                    legacy_scores = scores
+                elif legacy_scores is not None:
+                    result["max_abs_diff_vs_legacy"] = float(
+                        np.nanmax(np.abs(scores - legacy_scores))
+                    )
+                    result["same_nan_as_legacy"] = bool(
+                        (np.isnan(scores) == np.isnan(legacy_scores)).all()
+                    )
+                    result["within_float32_tolerance"] = bool(
+                        result["max_abs_diff_vs_legacy"] <= valencia.FLOAT32_TOLERANCE
+                    )
+                    result["same_calls_as_legacy"] = bool(
+                        (
+                            np.nanargmax(scores, axis=1)
+                            == np.nanargmax(legacy_scores, axis=1)
+                        ).all()
+                    )
+            case.update(result)
+            report["cases"].append(case)
+            if not case.get("same_calls_as_legacy", True) or not case.get(
+                "within_float32_tolerance", True
+            ):
+                failures.append(engine + " engine, " + str(n_samples) + " samples")
+            line = "{engine:>10} {samples:>9} samples: {seconds:10.3f} s, peak RSS {peak_rss_mb:9.1f} MB"
+            if case["worker_peak_rss_mb"] is not None:
+                line += ", largest worker {worker_peak_rss_mb:9.1f} MB"
+            print(line.format(**case))
+
+    with open(args.output, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print("Benchmark report written to " + args.output)
+    if failures:
+        sys.exit(
+            "CST calls differ from the legacy engine's, or scores by more than "
+            + str(valencia.FLOAT32_TOLERANCE)
+            + ", for: "
+            + "; ".join(failures)
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Times Valencia engines on synthetic count tables shaped like the centroid file's taxa, and writes wall time and peak RSS of each run to a JSON report. Each run happens in its own process."
+    )
+    parser.add_argument(
+        "--centroids",
+        default=str(
+            Path(sys.path[0]).parent / "data" / "valencia" / "CST_profiles_jan28_mean.csv"
+        ),
+        help="The CST centroids. Default: the pipeline's bundled centroids",
+    )
+    parser.add_argument(
+        "--samples",
+        nargs="+",
+        type=int,
+        default=[1000, 10000, 100000, 1000000],
+        metavar="N",
+        help="Cohort sizes to generate. Default: 1000 10000 100000 1000000",
+    )
+    parser.add_argument(
+        "--sparsity",
+        type=float,
+        default=0.9,
+        help="Fraction of taxa zeroed out in each sample. Default: 0.9",
+    )
+    parser.add_argument(
+        "--depth", type=int, default=50000, help="Approximate reads per sample. Default: 50000"
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=ENGINES,
+        default=ENGINES,
+        help="Engines to time. legacy is the original row-by-row yue_distance/penalized_simil_score path, float32 the dense engine in single precision. Default: all",
+    )
+    parser.add_argument(
+        "--legacy-max-samples",
+        type=int,
+        default=10000,
+        metavar="N",
+        help="Skip the legacy engine on cohorts larger than N; engines are compared against legacy on cohorts up to N. Default: 10000",
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=4, metavar="N", help="Worker processes for the parallel engine. Default: 4"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", "-o", default="valencia_benchmark.json", help="Default: valencia_benchmark.json"
+    )
+    main(parser.parse_args())
@@ -1,24 +1,89 @@
 #!/usr/bin/env python3
-import sys, os, subprocess, json
-from pathlib import Path
-import pandas as pd
+import sys, os, argparse, glob, importlib.util
+import numpy as np
+from Valencia_v1 import classify_csvs, read_centroids, SimilarityCache, CombinedWriter, FLOAT32_TOLERANCE
 
-config = json.load((Path(sys.path[0]).parent / Path("config.json")).open())
 
+def output_path(table):
+    return os.path.splitext(table)[0] + "_StR_CST.csv"
 
-input = sys.argv[2]
-temp = input + ".temp"
-df = pd.read_csv(input, header=0, index_col=0, sep=',')
-# Calculate the total read count for each sample and insert as 2nd column
-df.insert(0, 'read_count', df.sum(axis=1))
-df.to_csv(temp)
 
-process = subprocess.run([config["valencia_python"], "-s", os.path.join(sys.path[0], "Valencia_v1.py"), sys.argv[1], temp], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+# Expands any glob patterns among the table arguments (for when the shell didn't), keeping their order
+def expand_tables(patterns):
+    tables = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                sys.exit("No count tables match " + pattern)
+            tables.extend(matches)
+        else:
+            tables.append(pattern)
+    return tables
 
-# if Valencia exited 1, print Valencia's stderr and raise CalledProcessError to parent
-if process.returncode:
-    print(process.stderr.decode(sys.stdout.encoding))
-    process.check_returncode()  #Raises CalledProcessError which itself contains stderr
-else:
-    os.remove(temp)
-    sys.exit(process.returncode)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Assigns samples in count tables to vaginal community state types (CSTs) with Valencia. Writes <TABLE>_StR_CST.csv next to each count table."
+    )
+    parser.add_argument("centroids", metavar="CENTROIDS", help="The CST centroids (e.g. data/valencia/CST_profiles_jan28_mean.csv)")
+    parser.add_argument(
+        "tables",
+        metavar="TABLE",
+        nargs="+",
+        help="Count tables (or glob patterns) with sample IDs in the first column and one column of read counts per taxon. The centroids are loaded once for all of them.",
+    )
+    parser.add_argument(
+        "--chunksize",
+        metavar="N",
+        type=int,
+        help="Read, classify and write N samples at a time, so memory use no longer grows with the size of the table. Default: whole table at once",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        metavar="N",
+        type=int,
+        default=1,
+        help="Classify samples in N worker processes. Default: 1",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="FILE",
+        help="An SQLite file of similarity scores from earlier runs (created if missing). Samples whose counts and centroids are unchanged reuse their scores; only new or changed samples are classified and then added to the cache.",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="Hold relative abundances and similarity scores in single precision, halving their memory and speeding up the matrix products. Scores stay within "
+        + str(FLOAT32_TOLERANCE)
+        + " of the default double precision ones, so CST calls only differ for samples whose two best subCSTs are closer than that.",
+    )
+    parser.add_argument(
+        "--combined",
+        metavar="FILE",
+        help="Also write the read counts, similarity scores and CST calls of every table's samples to one Parquet file (Feather if FILE ends in .feather), with the table each sample came from in a source_table column. Needs pyarrow.",
+    )
+    args = parser.parse_args()
+
+    if args.combined is not None and importlib.util.find_spec("pyarrow") is None:
+        sys.exit("--combined needs pyarrow, which isn't installed")
+
+    tables = expand_tables(args.tables)
+    cache = SimilarityCache(args.cache) if args.cache is not None else None
+    combined = CombinedWriter(args.combined) if args.combined is not None else None
+    classify_csvs(
+        tables,
+        read_centroids(args.centroids),
+        [output_path(table) for table in tables],
+        chunksize=args.chunksize,
+        jobs=args.jobs,
+        cache=cache,
+        dtype=np.float32 if args.float32 else np.float64,
+        combined=combined,
+    )
+    if combined is not None:
+        combined.close()
+    if cache is not None:
+        print("Valencia cache: " + str(cache.hits) + " hits, " + str(cache.misses) + " misses")
+        cache.close()
@@ -0,0 +1,106 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+import Valencia_v1 as valencia
+
+CENTROIDS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "valencia", "CST_profiles_jan28_mean.csv")
+
+
+@pytest.fixture(scope="module")
+def centroid_frame():
+    return pd.read_csv(CENTROIDS_CSV, sep=",", index_col="sub_CST")
+
+
+# A few samples over part of the centroid taxa plus taxa the centroids don't have,
+# and one sample without any reads
+@pytest.fixture(scope="module")
+def counts_df(centroid_frame):
+    rng = np.random.default_rng(1)
+    taxa = list(centroid_frame.columns[:12]) + ["Not_a_centroid_taxon", "Another_unknown_taxon"]
+    profiles = centroid_frame.to_numpy()[rng.integers(0, len(valencia.CSTs), 20), :12]
+    counts = rng.poisson(np.column_stack([profiles, rng.random((20, 2)) * 0.05]) * 5000)
+    counts[7] = 0
+    return pd.DataFrame(counts, index=pd.Index(["sample" + str(i) for i in range(20)], name="sampleID"), columns=taxa)
+
+
+# What the original script computed: samples and centroids concatenated over the union
+# of their taxa, then yue_distance and penalized_simil_score applied row by row
+def legacy_calls(counts_df, centroid_frame):
+    taxa = list(dict.fromkeys(list(counts_df.columns) + list(centroid_frame.columns)))
+    read_count = counts_df.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sample_rel = counts_df.reindex(columns=taxa).fillna(0).div(read_count, axis=0)
+        medians = centroid_frame.reindex(columns=taxa).fillna(0)
+        sims = pd.DataFrame(index=counts_df.index)
+        for cst in valencia.CSTs:
+            median = medians.loc[cst].to_numpy()
+            sims[cst + "_sim"] = sample_rel.apply(lambda x: valencia.yue_distance(x.to_numpy(), median), axis=1)
+
+    scored = sims.notna().any(axis=1)
+    calls = sims.copy()
+    calls["sim_subCST"] = pd.Series(np.nan, index=sims.index, dtype=object)
+    calls["penalized_score"] = np.nan
+    calls.loc[scored, "sim_subCST"] = sims[scored].idxmax(axis=1).str.replace("_sim", "")
+    calls.loc[scored, "penalized_score"] = calls[scored].apply(
+        lambda row: valencia.penalized_simil_score(row[[cst + "_sim" for cst in valencia.CSTs] + ["sim_subCST"]]), axis=1
+    )
+    calls["score"] = sims.max(axis=1)
+    calls["sim_CST"] = calls["sim_subCST"].replace(valencia.subCST_to_CST)
+    return calls
+
+
+def test_matrix_scores_match_row_by_row(counts_df, centroid_frame):
+    expected = legacy_calls(counts_df, centroid_frame)
+    calls = valencia.classify(counts_df, centroid_frame)
+
+    for column in [cst + "_sim" for cst in valencia.CSTs] + ["penalized_score", "score"]:
+        assert np.allclose(calls[column].to_numpy(dtype=float), expected[column].to_numpy(dtype=float), equal_nan=True), column
+    # sample7 has no reads, see test_sample_without_reads_gets_no_call
+    assert calls["sim_subCST"].drop("sample7").tolist() == expected["sim_subCST"].drop("sample7").tolist()
+    assert calls["sim_CST"].drop("sample7").tolist() == expected["sim_CST"].drop("sample7").tolist()
+
+
+def test_sample_without_reads_gets_no_call(counts_df, centroid_frame):
+    calls = valencia.classify(counts_df, centroid_frame).loc["sample7"]
+
+    assert calls["read_count"] == 0
+    assert np.isnan(calls[[cst + "_sim" for cst in valencia.CSTs]].to_numpy(dtype=float)).all()
+    assert pd.isna(calls["sim_subCST"]) and pd.isna(calls["sim_CST"])
+    assert np.isnan(calls["penalized_score"]) and np.isnan(calls["score"])
+
+
+def test_penalized_scores_match_row_by_row(counts_df, centroid_frame):
+    similarity = valencia.similarity_to_centroids(counts_df, counts_df.sum(axis=1), valencia.Centroids.from_frame(centroid_frame))
+    best, penalized_score, score = valencia.penalized_simil_scores(similarity, valencia.CSTs)
+
+    for i, row in enumerate(similarity):
+        if np.isnan(row).all():
+            assert best[i] == -1 and np.isnan(penalized_score[i]) and np.isnan(score[i])
+            continue
+        sims = pd.Series(row, index=[cst + "_sim" for cst in valencia.CSTs])
+        subCST = sims.idxmax().replace("_sim", "")
+        assert valencia.CSTs[best[i]] == subCST
+        assert np.isclose(penalized_score[i], valencia.penalized_simil_score(pd.concat([sims, pd.Series({"sim_subCST": subCST})])))
+        assert score[i] == sims.max()
+
+
+# A cohort drawn around the bundled centroids, like valencia_benchmark.py's
+def test_float32_calls_match_float64(centroid_frame):
+    rng = np.random.default_rng(0)
+    centroids = valencia.Centroids.from_frame(centroid_frame)
+    profile = centroids.matrix[rng.integers(0, len(valencia.CSTs), 2000)]
+    profile += rng.random(profile.shape) * 0.02
+    profile[rng.random(profile.shape) < 0.9] = 0
+    counts_df = pd.DataFrame(rng.poisson(profile * 50000), columns=centroids.taxa)
+
+    double = valencia.classify(counts_df, centroids)
+    single = valencia.classify(counts_df, centroids, np.float32)
+
+    sims = [cst + "_sim" for cst in valencia.CSTs]
+    assert np.nanmax(np.abs(single[sims].to_numpy(dtype=np.float64) - double[sims].to_numpy(dtype=np.float64))) <= valencia.FLOAT32_TOLERANCE
+    assert single["sim_subCST"].equals(double["sim_subCST"])
+    assert single["sim_CST"].equals(double["sim_CST"])